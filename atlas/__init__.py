@@ -31,5 +31,15 @@ _logo = "icon.png"
 _references = ['delaRosaTrevin201693']
 
 
+# Number of locations above which viewers show their density instead of every point
+ATLAS_DENSITY_THRESHOLD = 'ATLAS_DENSITY_THRESHOLD'
+# Folder of the rendered atlas images cache, Tmp/atlas_render_cache of the project if empty
+ATLAS_RENDER_CACHE = 'ATLAS_RENDER_CACHE'
+
+
 class Plugin(pwem.Plugin):
-    pass
+
+    @classmethod
+    def _defineVariables(cls):
+        cls._defineVar(ATLAS_DENSITY_THRESHOLD, 50000)
+        cls._defineVar(ATLAS_RENDER_CACHE, "")
@@ -0,0 +1,284 @@
+# **************************************************************************
+# *
+# * Authors:   Pablo Conesa       (pconesa@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+from collections import OrderedDict
+
+
+class HoleLocationsCache:
+    """ Persistent cache of holes coordinates, stored in a sqlite file and keyed by (grid, gridSquare, hole).
+    Each entry keeps the modification time of the TargetLocation file it comes from, so entries of
+    changed files are not used. It can be shared by different parsers, steps and protocol runs."""
+
+    def __init__(self, dbFile):
+        self.dbFile = dbFile
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(dbFile, check_same_thread=False)
+        self._connection.execute("CREATE TABLE IF NOT EXISTS holes "
+                                 "(grid TEXT, gridSquare TEXT, hole TEXT, x REAL, y REAL, mTime INTEGER, "
+                                 "PRIMARY KEY (grid, gridSquare, hole))")
+        self._connection.commit()
+
+    def getGridSquare(self, grid, gridSquare):
+        """ Returns a dictionary hole -> (x, y, mTime) with all cached holes of a GridSquare"""
+        with self._lock:
+            rows = self._connection.execute("SELECT hole, x, y, mTime FROM holes WHERE grid=? AND gridSquare=?",
+                                            (grid, gridSquare)).fetchall()
+        return {hole: (x, y, mTime) for hole, x, y, mTime in rows}
+
+    def get(self, grid, gridSquare, hole, mTime):
+        """ Returns x, y of a hole, or None if not cached or cached from a file with a different modification time"""
+        with self._lock:
+            row = self._connection.execute("SELECT x, y FROM holes WHERE grid=? AND gridSquare=? AND hole=? AND mTime=?",
+                                           (grid, gridSquare, hole, mTime)).fetchone()
+        return row
+
+    def putMany(self, grid, gridSquare, holes):
+        """ Stores several holes of a GridSquare in a single transaction
+        :param holes: list of (hole, x, y, mTime)"""
+        if not holes:
+            return
+
+        with self._lock:
+            self._connection.executemany("INSERT OR REPLACE INTO holes VALUES (?, ?, ?, ?, ?, ?)",
+                                         [(grid, gridSquare, hole, x, y, mTime) for hole, x, y, mTime in holes])
+            self._connection.commit()
+
+    def importFrom(self, otherDbFile):
+        """ Adds the entries of another cache file not present in this one"""
+        if not os.path.exists(otherDbFile) or os.path.abspath(otherDbFile) == os.path.abspath(self.dbFile):
+            return
+
+        with self._lock:
+            self._connection.execute("ATTACH DATABASE ? AS other", (otherDbFile,))
+            try:
+                self._connection.execute("INSERT OR IGNORE INTO holes SELECT * FROM other.holes")
+                self._connection.commit()
+            except sqlite3.DatabaseError as e:
+                print("Can't import holes cache from %s: %s" % (otherDbFile, e))
+            finally:
+                self._connection.execute("DETACH DATABASE other")
+
+    def __len__(self):
+        with self._lock:
+            return self._connection.execute("SELECT COUNT(*) FROM holes").fetchone()[0]
+
+    def close(self):
+        self._connection.close()
+
+
+class LRUCache:
+    """ Dictionary like cache with a maximum size: when full, the least recently used items are evicted.
+    Size is the number of items, or the sum of their sizes if sizeOf is passed.
+    Keeps hits, misses and evictions counters to tell how useful it is."""
+
+    def __init__(self, capacity=100000, sizeOf=None):
+        """
+        :param capacity: maximum size of the cache
+        :param sizeOf: function returning the size of a value, 1 per item if None"""
+        self.capacity = capacity
+        self.sizeOf = sizeOf
+        self._items = OrderedDict()
+        self._sizes = {}
+        self._size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key):
+        """ Tells if key is cached, without counting it as a use"""
+        return key in self._items
+
+    def get(self, key, default=None):
+        """ Returns the cached value for key (counting a hit) or default (counting a miss)"""
+        try:
+            value = self._items[key]
+        except KeyError:
+            self.misses += 1
+            return default
+
+        self._items.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        """ Caches value for key, evicting the least recently used items if needed.
+        Put a value again when its size changes. The last item put is never evicted"""
+        size = 1 if self.sizeOf is None else self.sizeOf(value)
+        self._size += size - self._sizes.get(key, 0)
+        self._sizes[key] = size
+        self._items[key] = value
+        self._items.move_to_end(key)
+
+        while self._size > self.capacity and len(self._items) > 1:
+            evictedKey, evicted = self._items.popitem(last=False)
+            self._size -= self._sizes.pop(evictedKey)
+            self.evictions += 1
+
+    def getSize(self):
+        """ Returns the size of the cached items"""
+        return self._size
+
+    def clear(self):
+        self._items.clear()
+        self._sizes.clear()
+        self._size = 0
+
+    def getStats(self):
+        """ Returns a dictionary with size, capacity, items, hits, misses, evictions and hit ratio"""
+        lookups = self.hits + self.misses
+        return {"size": self._size,
+                "capacity": self.capacity,
+                "items": len(self._items),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hitRatio": self.hits / lookups if lookups else 0.0}
+
+
+class RenderCache:
+    """ Cache of rendered files (atlas images, pyramids...) addressed by their sources and render parameters.
+    Key is a hash of the real path, size and modification time of each source plus the parameters, so it changes
+    as soon as any source changes. Cached outputs are served by hard links (copies on other file systems).
+    A folder can be shared by any number of protocols and runs."""
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(folder, exist_ok=True)
+
+    @staticmethod
+    def getKey(sourceFiles, params=None):
+        """ Returns the key for the sources (files) rendered with params (json serializable dictionary)"""
+        key = hashlib.sha1()
+        for sourceFile in sourceFiles:
+            stat = os.stat(sourceFile)
+            key.update(("%s:%s:%s\n" % (os.path.realpath(sourceFile), stat.st_size, stat.st_mtime_ns)).encode())
+        key.update(json.dumps(params, sort_keys=True).encode())
+        return key.hexdigest()
+
+    def _getEntryFolder(self, key):
+        return os.path.join(self.folder, key)
+
+    def fetch(self, key, outputs):
+        """ Places the cached outputs of key at outputs paths, replacing them
+
+        :param outputs: list of files or folders, in the same order they were stored
+        :return True if they were cached, False otherwise"""
+        entryFolder = self._getEntryFolder(key)
+        if not os.path.isdir(entryFolder):
+            self.misses += 1
+            return False
+
+        for index, output in enumerate(outputs):
+            replaceWithLinks(os.path.join(entryFolder, str(index)), output)
+
+        self.hits += 1
+        return True
+
+    def store(self, key, outputs):
+        """ Caches the rendered outputs (files or folders) for key"""
+        entryFolder = self._getEntryFolder(key)
+        if os.path.isdir(entryFolder):
+            return
+
+        # Complete entries only: filled in a temporary folder and renamed
+        tmpFolder = tempfile.mkdtemp(prefix=".", dir=self.folder)
+        try:
+            # Outputs are cached by position, so they can be fetched with other names
+            for index, output in enumerate(outputs):
+                linkOrCopy(output, os.path.join(tmpFolder, str(index)))
+            os.rename(tmpFolder, entryFolder)
+        except OSError:
+            # Another process cached it first or the output can't be cached: leave the cache as it was
+            shutil.rmtree(tmpFolder, ignore_errors=True)
+
+    def render(self, sourceFiles, params, outputs, renderFunction):
+        """ Places at outputs the cached render of sourceFiles with params, calling renderFunction
+        (without arguments, it must write outputs) and caching its result when not cached
+
+        :return True if outputs came from the cache"""
+        key = self.getKey(sourceFiles, params)
+
+        if self.fetch(key, outputs):
+            return True
+
+        # Outputs might be links to cached files: writing over them would change the cache
+        for output in outputs:
+            if os.path.isdir(output):
+                shutil.rmtree(output)
+            elif os.path.exists(output):
+                os.remove(output)
+
+        renderFunction()
+        self.store(key, outputs)
+        return False
+
+
+def linkOrCopy(source, target):
+    """ Hard links source file at target (copies it if links are not possible). Folders are linked file by file"""
+    if os.path.isdir(source):
+        os.makedirs(target)
+        for entry in os.scandir(source):
+            linkOrCopy(entry.path, os.path.join(target, entry.name))
+        return
+
+    try:
+        os.link(source, target)
+    except OSError:
+        shutil.copy2(source, target)
+
+
+def replaceWithLinks(source, target):
+    """ Replaces target (file or folder) with links to source ones. Target is built aside and then renamed"""
+    # Already a link to source: a rename over it would do nothing
+    if os.path.isfile(target) and os.path.samefile(source, target):
+        return
+
+    parent, name = os.path.split(os.path.abspath(target))
+    tmpTarget = os.path.join(parent, ".%s.tmp" % name)
+
+    if os.path.isdir(tmpTarget):
+        shutil.rmtree(tmpTarget)
+    elif os.path.exists(tmpTarget):
+        os.remove(tmpTarget)
+
+    linkOrCopy(source, tmpTarget)
+
+    # Folders can't be replaced in a single rename
+    if os.path.isdir(target):
+        shutil.rmtree(target)
+
+    os.replace(tmpTarget, target)
@@ -23,8 +23,10 @@
 # *  e-mail address 'scipion@cnb.csic.es'
 # *
 # **************************************************************************
+import numpy as np
 from PIL import Image
 
+
 class Collage:
     """ Class to create collages from images of same size.
     Indexes of columns and rows start at 1"""
@@ -77,6 +79,61 @@ class Collage:
         # Move nextCord
         self._moveNextCoord(newImage)
 
+    def addImages(self, placements, size=None):
+        """ Adds several PIL images to the collage at once. Unlike calling addImage() for each of them,
+        the collage canvas is allocated only once, pasting each image once.
+        Result is the same as adding them one by one with addImage().
+    :parameter placements: iterable of (PIL image, coord) tuples. coord follows addImage() rules: x,y tuple or None
+    :parameter size: width, height tuple of the collage with all the images (e.g. AtlasLayout.getCanvasSize()).
+     If passed, each image is pasted as soon as placements yields it, so images are not all kept in memory.
+     Otherwise, all the images are taken first to calculate the final size"""
+
+        if size is None:
+            placements = list(placements)
+            size = self._getSizeWith(placements)
+
+        canvas = None
+
+        for newImage, coord in placements:
+
+            # First image of an empty collage goes to the origin (as addImage does)
+            if self._image is None and canvas is None:
+                coord = (0, 0)
+            elif coord is None:
+                coord = (self._nextCoordX, self._nextCoordY)
+
+            if canvas is None:
+                # Allocate the final canvas only once
+                mode = self._image.mode if self._image is not None else newImage.mode
+                width, height = self.getSize()
+                canvas = Image.new(mode, (max(width, size[0]), max(height, size[1])))
+                if self._image is not None:
+                    canvas.paste(self._image)
+
+            canvas.paste(newImage, coord)
+            self._moveNextCoord(newImage)
+
+        if canvas is not None:
+            self._image = canvas
+
+    def _getSizeWith(self, placements):
+        """ Returns the size of the collage once placements (see addImages()) are added, without adding them"""
+        width, height = self.getSize()
+        nextCoordX = self._nextCoordX
+
+        for index, (newImage, coord) in enumerate(placements):
+            if self._image is None and index == 0:
+                coord = (0, 0)
+            elif coord is None:
+                coord = (nextCoordX, self._nextCoordY)
+
+            newImageWith, newImageHeight = newImage.size
+            width = max(width, newImageWith + coord[0])
+            height = max(height, newImageHeight + coord[1])
+            nextCoordX += newImageWith
+
+        return width, height
+
     def _moveNextCoord(self, img):
         """ Moves nextCoord to the right by img.width"""
         x, y = img.size
@@ -100,7 +157,65 @@ class Collage:
          :returns (x,y)  coordinates for the next image."""
         return self._nextCoordX, self._nextCoordY
 
+    def getImage(self):
+        """ Returns the collage PIL image"""
+        return self._image
+
     def save(self, file):
         """ Saves the collage to the file passed
         :parameter file:   A filename (string), pathlib.Path object or file object."""
-        self._image.save(file)
\ No newline at end of file
+        self._image.save(file)
+
+
+class StripCollage:
+    """ Collage of 8 bits grayscale images composed and written to disk in horizontal strips.
+    Only the images crossing a strip are read for it, so memory needed is bounded by
+    strip height * width instead of the whole collage. Result is written as binary PGM.
+    Images are added as sources: functions returning a range of their rows on demand.
+    As in Collage, first image added goes to the origin and later images are pasted over previous ones."""
+
+    def __init__(self):
+        self._sources = []
+
+    def addSource(self, source, size, coord):
+        """ Adds an image source to the collage
+    :parameter source: function receiving (firstRow, lastRow) and returning those rows (last excluded) as a uint8 numpy array
+    :parameter size: width, height tuple of the image
+    :parameter coord: x,y tuple"""
+        if not self._sources:
+            coord = (0, 0)
+
+        self._sources.append((source, coord, size))
+
+    def addImage(self, newImage, coord):
+        """ Adds a PIL image to the collage. See addSource()"""
+        data = np.asarray(newImage.convert("L"))
+        self.addSource(lambda first, last: data[first:last], newImage.size, coord)
+
+    def getSize(self):
+        """ Returns the current size of the collage"""
+        width = max([x + w for source, (x, y), (w, h) in self._sources] or [0])
+        height = max([y + h for source, (x, y), (w, h) in self._sources] or [0])
+        return width, height
+
+    def save(self, file, stripHeight=1024):
+        """ Composes the collage strip by strip and writes each one to the file (binary PGM)
+        :parameter file: A filename
+        :parameter stripHeight: rows composed in memory at once"""
+        width, height = self.getSize()
+
+        with open(file, "wb") as f:
+            f.write(b"P5\n%d %d\n255\n" % (width, height))
+
+            for top in range(0, height, stripHeight):
+                bottom = min(top + stripHeight, height)
+                strip = np.zeros((bottom - top, width), dtype=np.uint8)
+
+                # Paste the part of each image crossing the strip
+                for source, (x, y), (w, h) in self._sources:
+                    if y < bottom and y + h > top:
+                        firstRow = max(top, y)
+                        lastRow = min(bottom, y + h)
+                        strip[firstRow - top:lastRow - top, x:x + w] = source(firstRow - y, lastRow - y)
+
+                f.write(strip.tobytes())
@@ -0,0 +1,93 @@
+# **************************************************************************
+# *
+# * Authors:   Pablo Conesa       (pconesa@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+import numpy as np
+
+
+class AtlasLayout:
+    """ Placement of the tiles of an atlas in the HR atlas, computed for all tiles at once.
+
+    Tile .dm files place each tile (AtlasPixelPosition) in a smaller canvas than the tiles mrc size,
+    so positions are scaled by the mrc width / dm width ratio of each tile. Position 1 stays 1.
+    As in Collage, first tile goes to the origin."""
+
+    def __init__(self, tileFiles, tileSizes, dmSizes, dmPositions):
+        """
+        :param tileFiles: list of tile files
+        :param tileSizes: (n, 2) array with width, height of each tile image
+        :param dmSizes: (n, 2) array with width, height of each tile in the dm files
+        :param dmPositions: (n, 2) array with x, y of each tile in the dm files"""
+        self.tileFiles = list(tileFiles)
+        self.tileSizes = np.asarray(tileSizes, dtype=np.int64).reshape((-1, 2))
+        self.dmSizes = np.asarray(dmSizes, dtype=np.int64).reshape((-1, 2))
+        self.dmPositions = np.asarray(dmPositions, dtype=np.int64).reshape((-1, 2))
+        self.coordinates = self._computeCoordinates()
+
+    def _computeCoordinates(self):
+        """ Returns the (n, 2) array with the x, y of each tile in the HR atlas"""
+        # Same ratio for x and y: tiles width in pixels / width in the dm files
+        ratios = self.tileSizes[:, 0] / self.dmSizes[:, 0]
+
+        coordinates = np.where(self.dmPositions == 1, 1,
+                               (self.dmPositions * ratios[:, np.newaxis]).astype(np.int64))
+
+        if len(coordinates):
+            coordinates[0] = 0
+
+        return coordinates
+
+    def __len__(self):
+        return len(self.tileFiles)
+
+    def __iter__(self):
+        """ Iterates over (tile file, (x, y), (width, height)) tuples"""
+        for tileFile, coord, size in zip(self.tileFiles, self.coordinates.tolist(), self.tileSizes.tolist()):
+            yield tileFile, tuple(coord), tuple(size)
+
+    def getCanvasSize(self):
+        """ Returns width, height of the HR atlas"""
+        if not len(self):
+            return 0, 0
+
+        width, height = (self.coordinates + self.tileSizes).max(axis=0)
+        return int(width), int(height)
+
+    def getTilesAt(self, x, y):
+        """ Returns the indexes of the tiles covering a pixel of the HR atlas"""
+        ends = self.coordinates + self.tileSizes
+        covering = ((self.coordinates[:, 0] <= x) & (x < ends[:, 0]) &
+                    (self.coordinates[:, 1] <= y) & (y < ends[:, 1]))
+        return np.flatnonzero(covering)
+
+    def save(self, layoutFile):
+        """ Saves the layout to a numpy .npz file, to load it instead of reading all the tiles again"""
+        np.savez(layoutFile, tileFiles=np.array(self.tileFiles, dtype=str), tileSizes=self.tileSizes,
+                 dmSizes=self.dmSizes, dmPositions=self.dmPositions)
+
+    @classmethod
+    def load(cls, layoutFile):
+        """ Returns a layout saved with save()"""
+        with np.load(layoutFile) as arrays:
+            return cls(arrays["tileFiles"].tolist(), arrays["tileSizes"], arrays["dmSizes"], arrays["dmPositions"])
@@ -0,0 +1,95 @@
+# **************************************************************************
+# *
+# * Authors:   Pablo Conesa       (pconesa@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+import os
+import struct
+
+import numpy as np
+
+MRC_HEADER_SIZE = 1024
+
+# MRC mode -> numpy data type
+MRC_MODES = {
+    0: np.int8,
+    1: np.int16,
+    2: np.float32,
+    6: np.uint16,
+    12: np.float16
+}
+
+
+class MrcFile:
+    """ Lightweight mrc reader. Parses the 1024 bytes header once and exposes the
+    pixels as a read only numpy.memmap, so only the pixels used are actually read from disk."""
+
+    def __init__(self, fileName):
+        self.fileName = fileName
+        self._data = None
+        self._readHeader()
+
+    def _readHeader(self):
+        """ Reads dimensions, mode and extended header size from the header"""
+        with open(self.fileName, "rb") as f:
+            header = f.read(MRC_HEADER_SIZE)
+
+        if len(header) < MRC_HEADER_SIZE:
+            raise ValueError("%s is not an mrc file: header is too short." % self.fileName)
+
+        # Machine stamp (byte 213) tells the byte order: 0x11 for big endian, 0x44 for little endian
+        byteOrder = ">" if header[212] == 0x11 else "<"
+
+        self.nx, self.ny, self.nz, self.mode = struct.unpack(byteOrder + "4i", header[0:16])
+        self.extendedHeaderSize = struct.unpack(byteOrder + "i", header[92:96])[0]
+
+        if self.mode not in MRC_MODES:
+            raise ValueError("Mrc mode %s of %s is not supported." % (self.mode, self.fileName))
+
+        self.dtype = np.dtype(MRC_MODES[self.mode]).newbyteorder(byteOrder)
+
+    def getDimensions(self):
+        """ Returns (x, y, z, n) as ImageHandler.getDimensions does for mrc files"""
+        return self.nx, self.ny, self.nz, 1
+
+    def getDataSize(self):
+        """ Returns the size in bytes the file has once all its pixels are written"""
+        return MRC_HEADER_SIZE + self.extendedHeaderSize + self.nx * self.ny * self.nz * self.dtype.itemsize
+
+    def isComplete(self):
+        """ Returns True if all the pixels are in the file, False while it is still being written"""
+        return os.path.getsize(self.fileName) >= self.getDataSize()
+
+    def getData(self, step=1):
+        """ Returns the pixels as a read only numpy.memmap: (y, x) shaped for 2D images, (z, y, x) otherwise
+
+        :parameter step: take one pixel out of step in x and y, to get a downsampled view without reading all pixels"""
+        if self._data is None:
+            shape = (self.ny, self.nx) if self.nz == 1 else (self.nz, self.ny, self.nx)
+            self._data = np.memmap(self.fileName, dtype=self.dtype, mode="r",
+                                   offset=MRC_HEADER_SIZE + self.extendedHeaderSize, shape=shape)
+
+        if step > 1:
+            return self._data[..., ::step, ::step]
+
+        return self._data
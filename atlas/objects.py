@@ -24,6 +24,7 @@
 # *
 # **************************************************************************
 from pwem.objects import EMObject, EMSet
+from pyworkflow.mapper.sqlite import ID
 from pyworkflow.object import String, Float
 
 
@@ -40,3 +41,33 @@ class SetOfAtlasLocations(EMSet):
     """ Set containing Atlas Location items. """
     ITEM_TYPE = AtlasLocation
 
+
+def selectColumns(emSet, labels, minId=None):
+    """ Reads some attributes of the items of a set straight from its sqlite, in a single query and
+    without building any item object.
+
+    :param emSet: set to read from
+    :param labels: list of item attributes to read, e.g. ["_filename"] or ["grid", "x", "y"]. Use "id" for the item id
+    :param minId: if passed, only items with a greater id are read
+    :return list of rows with the values in labels order, sorted by id"""
+
+    # NOTE: Accessing the db object since there is no method in the mapper to read only some columns
+    db = emSet._getMapper().db
+
+    # Empty sets might not have tables yet
+    if db.missingTables():
+        return []
+
+    # Map attributes to its table columns: _filename -> c01
+    columns = {row['label_property']: row['column_name'] for row in db.getClassRows()}
+    columns[ID] = ID
+
+    query = "SELECT %s FROM %sObjects" % (", ".join(columns[label] for label in labels), db.tablePrefix)
+    args = ()
+
+    if minId is not None:
+        query += " WHERE %s > ?" % ID
+        args = (minId,)
+
+    db.executeCommand(query + " ORDER BY %s" % ID, args)
+    return db.cursor.fetchall()
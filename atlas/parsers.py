@@ -26,18 +26,45 @@
 import os
 import re
 import tempfile
+import time
 import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from functools import partial
 
+import numpy as np
 from PIL import Image
-from pwem.emlib.image import ImageHandler
 
-from atlas.collage import Collage
+from atlas.cache import LRUCache
+from atlas.collage import Collage, StripCollage
+from atlas.layout import AtlasLayout
+from atlas.mrc import MrcFile
 from atlas.objects import AtlasLocation
+from atlas.pyramid import DeepZoomPyramid
+from atlas.stats import HotPathStats
 
 ATLAS_ATTR = "atlasLoc"
 GRID_ = "GRID_"
 GRIDSQUARE_MD = GRIDSQUARE_IMG = "GridSquare_"
 TARGET_LOCATION_FILE_PATTERN = "TargetLocation_%s.dm"
+ATLAS_MRC = "Atlas_1.mrc"
+
+# Movie file name with grid, gridSquare and hole ids: GRID_#*_*_GridSquare_#*_*_FoilHole_#*
+MOVIE_FN_PATTERN = re.compile(GRID_ + r"(\d*)_.*_" + GRIDSQUARE_IMG + r"(\d*)_.*_FoilHole_(\d*)")
+
+# Columns of EPUParser.getAtlasLocations results
+ATLAS_LOCATIONS_DTYPE = np.dtype([("grid", "U8"), ("gridSquare", "U20"), ("hole", "U20"),
+                                  ("x", np.float64), ("y", np.float64), ("found", bool)])
+
+# Default maximum number of holes coordinates the parser keeps in memory
+HOLES_CAPACITY = 100000
+
+# Raw dm (xml) patterns: start tag whose name contains a text, root start tag and namespace declarations
+DM_START_TAG = rb"<((?:[\w.-]+:)?%s)[\s>]"
+DM_ROOT_TAG = re.compile(rb"<[^?!][^>]*>")
+DM_NAMESPACE = re.compile(rb"""xmlns(?::[\w.-]+)?\s*=\s*(?:"[^"]*"|'[^']*')""")
+# Start tags (not end tags, declarations or comments) and self closing tag ends, to tell an element depth
+DM_OPENING = re.compile(rb"<[^/?!]")
+DM_SELF_CLOSING = re.compile(rb"/>")
 
 
 def setAtlasToMovie(movie, atlasLocation):
@@ -50,52 +77,338 @@ def getAtlasFromMovie(movie):
     return getattr(movie, ATLAS_ATTR, None)
 
 
+def saveAtomically(image, outputFile):
+    """ Saves a PIL image so outputFile is never seen half written: image goes to a temporary file
+    in the same folder that is then renamed to outputFile"""
+    root, extension = os.path.splitext(outputFile)
+    tmpFile = root + ".tmp" + extension
+
+    try:
+        image.save(tmpFile)
+        os.replace(tmpFile, outputFile)
+    except Exception:
+        if os.path.exists(tmpFile):
+            os.remove(tmpFile)
+        raise
+
+
+def iterDmChildren(dmFile, parentTag):
+    """ Yields tag, text of the children of the first child of the root of a dm (xml) file named parentTag
+    (ignoring its namespace). Instead of building the whole xml tree, the element is located in the raw bytes
+    and only it is parsed (with the namespaces declared at the root). If that is not possible, the whole file is parsed."""
+
+    with open(dmFile, "rb") as f:
+        content = f.read()
+
+    parent = None
+    start = re.search(DM_START_TAG % re.escape(parentTag.encode()), content)
+    rootTag = DM_ROOT_TAG.search(content)
+
+    # Only a direct child of the root: what is in between is balanced
+    if start is not None and rootTag is not None and rootTag.end() <= start.start():
+        inBetween = content[rootTag.end():start.start()]
+        opened = len(DM_OPENING.findall(inBetween)) - len(DM_SELF_CLOSING.findall(inBetween))
+        if opened != inBetween.count(b"</"):
+            start = None
+    else:
+        start = None
+
+    if start is not None:
+        qName = start.group(1)
+        end = content.find(b"</" + qName + b">", start.end())
+
+        if end != -1:
+            # Wrap the element with the root namespaces declarations, so tags are the same as in the whole tree
+            namespaces = b" ".join(DM_NAMESPACE.findall(rootTag.group(0)))
+            fragment = b"<root %s>%s</root>" % (namespaces, content[start.start():end + len(qName) + 3])
+            try:
+                parent = ET.fromstring(fragment)[0]
+            except ET.ParseError:
+                # e.g. namespace declared by an element in between
+                parent = None
+
+    if parent is None:
+        for element in ET.fromstring(content):
+            if element.tag.split("}")[-1] == parentTag:
+                parent = element
+                break
+        else:
+            return
+
+    for child in parent:
+        yield child.tag, child.text
+
+
+class GridSquareIndex:
+    """ Table of hole -> (x, y) stage coordinates of all the TargetLocation files in a GridSquare metadata folder.
+    Folder is scanned once, and only new files are read when the folder modification time changes,
+    so getting coordinates of indexed holes does not involve any file access."""
+
+    def __init__(self, gridSquareFolder, grid=None, gridSquare=None, holesCache=None):
+        """
+        :param gridSquareFolder: GridSquare metadata folder
+        :param grid: grid id, needed to use holesCache
+        :param gridSquare: gridSquare id, needed to use holesCache
+        :param holesCache: optional HoleLocationsCache to avoid reading files already read by others"""
+        self.gridSquareFolder = gridSquareFolder
+        self.grid = grid
+        self.gridSquare = gridSquare
+        self.holesCache = holesCache
+        self._coordinates = {}
+        self._mTime = None
+
+    def __len__(self):
+        return len(self._coordinates)
+
+    def __contains__(self, holeId):
+        """ Tells if the hole is indexed, without refreshing"""
+        return holeId in self._coordinates
+
+    def refresh(self, force=False):
+        """ Reads the TargetLocation files not indexed yet, if the folder has changed since last refresh or force is True"""
+        try:
+            mTime = os.stat(self.gridSquareFolder).st_mtime_ns
+        except OSError:
+            return
+
+        if mTime == self._mTime and not force:
+            return
+
+        # Holes read previously, by this or any other parser, are taken from the cache
+        cached = {}
+        if self.holesCache is not None and self._mTime is None:
+            cached = self.holesCache.getGridSquare(self.grid, self.gridSquare)
+
+        self._mTime = mTime
+        prefix, suffix = TARGET_LOCATION_FILE_PATTERN.split("%s")
+        newHoles = []
+
+        with os.scandir(self.gridSquareFolder) as entries:
+            for entry in entries:
+                name = entry.name
+                if name.startswith(prefix) and name.endswith(suffix):
+                    holeId = name[len(prefix):-len(suffix)]
+
+                    if holeId not in self._coordinates:
+                        fileMTime = entry.stat().st_mtime_ns
+
+                        # Cached from the same file version
+                        if holeId in cached and cached[holeId][2] == fileMTime:
+                            self._coordinates[holeId] = cached[holeId][:2]
+                            continue
+
+                        try:
+                            x, y = EPUParser.getTargetLocationCoordinates(entry.path)
+                        except ET.ParseError:
+                            # File might still being written, it will be read in a later refresh
+                            continue
+                        except Exception as e:
+                            # Malformed file: do not stop indexing the rest of holes
+                            print("Can't read hole coordinates from %s: %s" % (entry.path, e))
+                            continue
+
+                        self._coordinates[holeId] = x, y
+                        newHoles.append((holeId, x, y, fileMTime))
+
+        if self.holesCache is not None:
+            self.holesCache.putMany(self.grid, self.gridSquare, newHoles)
+
+    def getCoordinates(self, holeId):
+        """ Returns x, y of the hole or None if there is no TargetLocation file for it"""
+        if holeId not in self._coordinates:
+            self.refresh(force=self._mTime is not None)
+
+        return self._coordinates.get(holeId)
+
+
+class EPUSessionIndex:
+    """ Tables of the folders and files of an EPU session, read walking the folders common to all grids once:
+
+    - grids: grid id -> GRID_XX folder
+    - atlas: grid id -> Atlas_1.mrc (only when present)
+    - gridSquares: (grid id, gridSquare id) -> GridSquare metadata folder
+
+    Refreshes only list again the folders whose modification time has changed. Holes of a GridSquare
+    are listed by its GridSquareIndex."""
+
+    def __init__(self, rootFolder, minRefreshSecs=1.0):
+        """
+        :param rootFolder: folder containing the GRID_XX folders
+        :param minRefreshSecs: refreshes to find unknown items are not done more often than this"""
+        self.rootFolder = rootFolder
+        self.minRefreshSecs = minRefreshSecs
+        self.grids = {}
+        self.atlas = {}
+        self.gridSquares = {}
+        self._mTimes = {}
+        # Time of the last refresh, with and without the Metadata folders
+        self._lastRefresh = {True: None, False: None}
+
+    def _hasChanged(self, folder):
+        """ Returns True if the folder content might have changed since it was listed, recording its current time"""
+        try:
+            mTime = os.stat(folder).st_mtime_ns
+        except OSError:
+            return False
+
+        if self._mTimes.get(folder) == mTime:
+            return False
+
+        # Changes in the same time tick of the listing would go unnoticed: list recent folders again next time
+        if time.time_ns() - mTime > self.minRefreshSecs * 1e9:
+            self._mTimes[folder] = mTime
+        else:
+            self._mTimes.pop(folder, None)
+
+        return True
+
+    def refresh(self, gridSquares=True):
+        """ Lists the changed folders of the session
+
+        :param gridSquares: if False, only the grids and their ATLAS folders are listed, not the Metadata ones"""
+        now = time.time()
+        self._lastRefresh[False] = now
+        if gridSquares:
+            self._lastRefresh[True] = now
+
+        if self._hasChanged(self.rootFolder):
+            with os.scandir(self.rootFolder) as entries:
+                for entry in entries:
+                    if entry.name.startswith(GRID_) and entry.is_dir():
+                        self.grids.setdefault(entry.name[len(GRID_):], entry.path)
+
+        for grid, gridFolder in self.grids.items():
+            self._refreshAtlas(grid, EPUParser._getAtlasFolderFn(gridFolder))
+            if gridSquares:
+                self._refreshMetadata(grid, EPUParser._getMetadataFolderFn(gridFolder))
+
+    def _refreshAtlas(self, grid, atlasFolder):
+        if not self._hasChanged(atlasFolder):
+            return
+
+        self.atlas.pop(grid, None)
+        atlasMRC = os.path.join(atlasFolder, ATLAS_MRC)
+        if os.path.exists(atlasMRC):
+            self.atlas[grid] = atlasMRC
+
+    def _refreshMetadata(self, grid, metadataFolder):
+        if not self._hasChanged(metadataFolder):
+            return
+
+        with os.scandir(metadataFolder) as entries:
+            for entry in entries:
+                if entry.name.startswith(GRIDSQUARE_MD) and entry.is_dir():
+                    self.gridSquares.setdefault((grid, entry.name[len(GRIDSQUARE_MD):]), entry.path)
+
+    def refreshIfDue(self, gridSquares=True):
+        """ Refreshes, unless the last refresh is too recent. Returns True if refreshed"""
+        lastRefresh = self._lastRefresh[gridSquares]
+        if lastRefresh is not None and time.time() - lastRefresh < self.minRefreshSecs:
+            return False
+
+        self.refresh(gridSquares=gridSquares)
+        return True
+
+    def _lookup(self, table, key, gridSquares=False):
+        """ Returns the value of key in a table, refreshing the index once if not there (None if not found)"""
+        value = table.get(key)
+        if value is None and self.refreshIfDue(gridSquares=gridSquares):
+            value = table.get(key)
+        return value
+
+    def getGridFolder(self, grid):
+        return self._lookup(self.grids, grid)
+
+    def getAtlas(self, grid):
+        return self._lookup(self.atlas, grid)
+
+    def getGridSquareFolder(self, grid, gridSquare):
+        return self._lookup(self.gridSquares, (grid, gridSquare), gridSquares=True)
+
+
 class EPUParser:
     """ Parses ATLAS files generated by EPU. """
     # EPU images name example:
     # GRID_05_DATA_Images - Disc1_GridSquare_1818984_DATA_FoilHole_2872127_Data_1821842_1821843_20190904_0831_Fractions_global_shifts.png
-    def __init__(self, importPath):
-        self._holesLocations = {}
+    def __init__(self, importPath, holesCapacity=HOLES_CAPACITY, stats=None):
+        """
+        :param importPath: path to the movies, containing GRID_
+        :param holesCapacity: maximum number of holes coordinates kept in memory. When exceeded, the indexes
+         of the least recently used GridSquares are discarded
+        :param stats: HotPathStats to record the metadata reading times in, a new one if None"""
+        self.stats = HotPathStats() if stats is None else stats
+        # GridSquare indexes, sized by their number of holes
+        self._gridSquareIndexes = LRUCache(holesCapacity, sizeOf=len)
+        self._holesCache = None
+        self._sessionIndex = None
         self.importPath = importPath
 
+    def setHolesCache(self, holesCache):
+        """ Sets a persistent HoleLocationsCache to share holes coordinates with other parsers"""
+        self._holesCache = holesCache
+
     def _getTargetLocationDmPath(self, atlasLocation):
         """ Returns the path of the TargetLocation dm file based on the altasLocation.hole identifier (FoilHole number)"""
-        return os.path.join(self._getGridSquareMDFolder(atlasLocation),
-                            TARGET_LOCATION_FILE_PATTERN % atlasLocation.hole)
+        return self._getTargetLocationDmPathById(atlasLocation.grid.get(), atlasLocation.gridSquare.get(),
+                                                 atlasLocation.hole.get())
+
+    def _getTargetLocationDmPathById(self, grid, gridSquare, hole):
+        """ Returns the path of the TargetLocation dm file of a hole"""
+        return os.path.join(self._getGridSquareMDFolderById(grid, gridSquare),
+                            TARGET_LOCATION_FILE_PATTERN % hole)
 
     def _getCommonPathToAllGrids(self):
         """ Returns the path common to all grids: Assumes path contains GRID_"""
         return self.importPath.split(GRID_)[0]
 
+    def getSessionIndex(self):
+        """ Returns the index of the session folders and files, walking them the first time"""
+        if self._sessionIndex is None:
+            self._sessionIndex = EPUSessionIndex(self._getCommonPathToAllGrids())
+            self._sessionIndex.refresh()
+
+        return self._sessionIndex
+
     def getAllGRIDFolders(self):
-        commonPath = self._getCommonPathToAllGrids()
-        for gridFolder in os.listdir(commonPath):
-            fullPath = os.path.join(commonPath,gridFolder)
-            # If it's a folder and starts with GRID_
-            if os.path.isdir(fullPath) and gridFolder.startswith(GRID_):
-                yield gridFolder, fullPath
+        index = self.getSessionIndex()
+        # New grids might have appeared: GridSquares are not needed
+        index.refreshIfDue(gridSquares=False)
+
+        for grid, fullPath in sorted(index.grids.items()):
+            yield GRID_ + grid, fullPath
 
     def getAllAtlas(self):
         """ Returns all atlas files present under the import path"""
+        index = self.getSessionIndex()
         for gridFolder, fullPath in self.getAllGRIDFolders():
 
             # Get the atlas folder
-            atlasFolder = self._getAtlasFolderFn(fullPath)
-            yield gridFolder, self._getAtlasMrcImageFn(atlasFolder)
+            atlasFn = index.atlas.get(gridFolder[len(GRID_):])
+            yield gridFolder, atlasFn or self._getAtlasMrcImageFn(self._getAtlasFolderFn(fullPath))
 
     def _getGridFolder(self, atlasLocation):
         """ Returns the path for a specific GRID"""
-        return os.path.join(self._getCommonPathToAllGrids(), GRID_ + atlasLocation.grid.get())
+        return self._getGridFolderById(atlasLocation.grid.get())
+
+    def _getGridFolderById(self, grid):
+        """ Returns the path for a specific GRID id"""
+        return (self.getSessionIndex().getGridFolder(grid) or
+                os.path.join(self._getCommonPathToAllGrids(), GRID_ + grid))
 
     def _getMetadataFolder(self, atlasLocation):
         """ Returns the metadata folder for a specific GRID: Assumes the following file structure:
         GRID_XX/DATA/Metadata"""
-        return os.path.join(self._getGridFolder(atlasLocation), "DATA", "Metadata")
+        return self._getMetadataFolderFn(self._getGridFolder(atlasLocation))
 
     def _getGridSquareMDFolder(self, atlasLocation):
         """ Returns the gridSquare folder under metadata folder"""
 
-        return os.path.join(self._getMetadataFolder(atlasLocation), GRIDSQUARE_MD + atlasLocation.gridSquare.get())
+        return self._getGridSquareMDFolderById(atlasLocation.grid.get(), atlasLocation.gridSquare.get())
+
+    def _getGridSquareMDFolderById(self, grid, gridSquare):
+        """ Returns the gridSquare folder under metadata folder for grid and gridSquare ids"""
+        return (self.getSessionIndex().getGridSquareFolder(grid, gridSquare) or
+                os.path.join(self._getMetadataFolderFn(self._getGridFolderById(grid)), GRIDSQUARE_MD + gridSquare))
 
     def _getAtlasMrcImage(self, atlasLocation):
         """ Returns the atlas image under ATLAS folder named Atlas_1.mrc"""
@@ -111,61 +424,140 @@ class EPUParser:
         GRID_05_DATA_Images - Disc1_GridSquare_1818984_DATA_FoilHole_2872127_Data_1821842_1821843_20190904_0831_Fractions_global_shifts.png
         """
         movieFn = movie.getFileName()
+        location = self.getAtlasLocations([movieFn])[0]
 
-        matchingString = GRID_ + "(\d*)_.*_" + GRIDSQUARE_IMG + "(\d*)_.*_FoilHole_(\d*)"
+        if not location['found']:
+            raise ValueError("Can't find the atlas location of %s." % movieFn)
 
-        m = re.search(matchingString, movieFn)
         atlasLocation = AtlasLocation()
-        atlasLocation.grid.set(m.group(1))
-        atlasLocation.gridSquare.set(m.group(2))
-        atlasLocation.hole.set(m.group(3))
-        x, y = self._getCoordinates(atlasLocation)
-        atlasLocation.x.set(x)
-        atlasLocation.y.set(y)
+        atlasLocation.grid.set(str(location['grid']))
+        atlasLocation.gridSquare.set(str(location['gridSquare']))
+        atlasLocation.hole.set(str(location['hole']))
+        atlasLocation.x.set(float(location['x']))
+        atlasLocation.y.set(float(location['y']))
 
         return atlasLocation
 
+    def getAtlasLocations(self, movieFns):
+        """ Batch version of getAtlasLocation: finds grid, gridSquare, hole, x and y of several movie files
+        without creating any object per movie.
+
+        :param movieFns: iterable of movie file names
+        :return numpy structured array (ATLAS_LOCATIONS_DTYPE), a row per movie in the same order.
+        Rows with found=False could not be located (x and y are nan)"""
+        grids, gridSquares, holes = [], [], []
+        xs, ys, found = [], [], []
+        search = MOVIE_FN_PATTERN.search
+
+        for movieFn in movieFns:
+            m = search(movieFn)
+            x = y = np.nan
+            located = False
+
+            if m is None:
+                grid = gridSquare = hole = ""
+                print("EPU parser can't find grid, gridSquare and hole ids in %s." % movieFn)
+            else:
+                grid, gridSquare, hole = m.groups()
+                try:
+                    x, y = self._getCoordinatesById(grid, gridSquare, hole)
+                    located = True
+                except Exception as e:
+                    print("EPU parser can't find atlas location for %s. Error: %s" % (movieFn, e))
+
+            grids.append(grid)
+            gridSquares.append(gridSquare)
+            holes.append(hole)
+            xs.append(x)
+            ys.append(y)
+            found.append(located)
+
+        locations = np.empty(len(grids), dtype=ATLAS_LOCATIONS_DTYPE)
+        for name, column in zip(ATLAS_LOCATIONS_DTYPE.names, (grids, gridSquares, holes, xs, ys, found)):
+            locations[name] = column
+
+        return locations
+
     def _getCoordinates(self, atlasLocation):
 
-        holeId = atlasLocation.hole.get()
+        return self._getCoordinatesById(atlasLocation.grid.get(), atlasLocation.gridSquare.get(),
+                                        atlasLocation.hole.get())
+
+    def _getCoordinatesById(self, grid, gridSquare, holeId):
+        """ Returns x, y of a hole"""
+        # Hole ids are only unique within a GridSquare
+        index = self._getGridSquareIndex(grid, gridSquare)
+
+        if holeId in index:
+            return index.getCoordinates(holeId)
 
-        if holeId not in self._holesLocations:
-            self._holesLocations[holeId] = self.findCooordinatesFromHoleId(atlasLocation)
+        # Only misses are timed, hits are counted by the cache
+        with self.stats.timer("holeCoordinatesMiss"):
+            # All new holes of the GridSquare are indexed at once
+            holes = len(index)
+            coordinates = index.getCoordinates(holeId)
 
-        return self._holesLocations[holeId]
+            # Index has grown: other GridSquares are discarded if there are too many holes in memory
+            if len(index) != holes:
+                self._gridSquareIndexes.put((grid, gridSquare), index)
+
+            # Hole not indexed (e.g. file missing): try to read it
+            if coordinates is None:
+                coordinates = self.getTargetLocationCoordinates(
+                    self._getTargetLocationDmPathById(grid, gridSquare, holeId))
+
+        return coordinates
+
+    def _getGridSquareIndex(self, grid, gridSquare):
+        """ Returns the index of holes coordinates of a GridSquare"""
+        index = self._gridSquareIndexes.get((grid, gridSquare))
+
+        if index is None:
+            index = GridSquareIndex(self._getGridSquareMDFolderById(grid, gridSquare), grid=grid,
+                                    gridSquare=gridSquare, holesCache=self._holesCache)
+            self._gridSquareIndexes.put((grid, gridSquare), index)
+
+        return index
+
+    def getCacheStats(self):
+        """ Returns the statistics (see LRUCache.getStats) of the in memory caches: holes coordinates,
+        kept in GridSquare indexes"""
+        return {"holes": self._gridSquareIndexes.getStats()}
 
     def findCooordinatesFromHoleId(self, atlasLocation):
 
-        targetLocationMDfile = self._getTargetLocationDmPath(atlasLocation)
+        return self.getTargetLocationCoordinates(self._getTargetLocationDmPath(atlasLocation))
 
-        # Open the medatata file, is an xml
-        root = ET.parse(targetLocationMDfile).getroot()
+    @staticmethod
+    def getTargetLocationCoordinates(targetLocationMDfile):
+        """ Returns x, y stage position from the xml of the TargetLocation file"""
 
         x = 0
         y = 0
 
-        # Find the StagePosition element
-        for element in root:
-            if "StagePosition" in element.tag:
-
-                # Get the coordinates
-                for stageChild in element:
+        # Read the StagePosition element of the medatata file (xml) and nothing after it
+        for tag, text in iterDmChildren(targetLocationMDfile, "StagePosition"):
 
-                    lastChar = stageChild.tag[-1]
+            lastChar = tag[-1]
 
-                    # Assuming order
-                    if "X" == lastChar:
-                        x = stageChild.text
-                    elif "Y" == lastChar:
-                        y = stageChild.text
-                        break
+            # Assuming order
+            if "X" == lastChar:
+                x = float(text)
+            elif "Y" == lastChar:
+                y = float(text)
+                break
 
         return x, y
 
     @staticmethod
     def _getAtlasMrcImageFn(atlasFolder):
         """ Returns the atlas image under folder passed named Atlas_1.mrc"""
-        return os.path.join(atlasFolder, "Atlas_1.mrc")
+        return os.path.join(atlasFolder, ATLAS_MRC)
+
+    @staticmethod
+    def _getMetadataFolderFn(gridFolder):
+        """ Having a grid folder, returns it's metadata folder"""
+        return os.path.join(gridFolder, "DATA", "Metadata")
 
     @staticmethod
     def _getAtlasFolderFn(gridFolder):
@@ -185,85 +577,253 @@ class EPUParser:
     @staticmethod
     def getTileCoordinates(tileDmFile):
         """ Returns height, with, x, y from the xml fo the tile file"""
-        # Open the medatata file, is an xml
-        root = ET.parse(tileDmFile).getroot()
-
         x = 0
         y = 0
 
-        # Find the StagePosition element
-        for element in root:
-            if "AtlasPixelPosition" in element.tag:
-
-                # Get the coordinates
-                for child in element:
+        # Read the AtlasPixelPosition element of the medatata file (xml) and nothing after it
+        for tag, text in iterDmChildren(tileDmFile, "AtlasPixelPosition"):
 
-                    lastChar = child.tag[-1]
+            lastChar = tag[-1]
 
-                    # Assuming order
-                    if "height" in child.tag:
-                        height = int(child.text)
-                    elif "width" in child.tag:
-                        width = int(child.text)
-                    elif "x" == lastChar:
-                        x = int(child.text)
-                    elif "y" == lastChar:
-                        y = int(child.text)
-                        break
+            # Assuming order
+            if "height" in tag:
+                height = int(text)
+            elif "width" in tag:
+                width = int(text)
+            elif "x" == lastChar:
+                x = int(text)
+            elif "y" == lastChar:
+                y = int(text)
+                break
 
         return height, width, x, y
 
+    @classmethod
+    def convertMrc2Jpg(cls, mrcfile, ouptut, maxSize=None):
+        cls.readMrcImage(mrcfile, maxSize=maxSize).save(ouptut)
+
+    def createLRAtlas(self, atlasMRC, outputFile, maxSize=None, pyramidFile=None, tileSize=256, renderCache=None):
+        """ Converts the atlas mrc to jpg. If maxSize is passed atlas is downsampled so its largest side is not bigger
+
+        :parameter pyramidFile: if passed, a DeepZoom pyramid (.dzi) of the atlas is written too, so viewers
+         can read only the resolution they need
+        :parameter tileSize: size of the pyramid tiles
+        :parameter renderCache: RenderCache to take the images from if the atlas has not changed since they were cached
+        :returns True if the images came from renderCache"""
+        render = partial(self._renderLRAtlas, atlasMRC, outputFile, maxSize=maxSize, pyramidFile=pyramidFile,
+                         tileSize=tileSize)
+
+        if renderCache is None:
+            render()
+            return False
+
+        params = {"render": "LRAtlas", "format": os.path.splitext(outputFile)[1].lower(), "maxSize": maxSize,
+                  "pyramid": bool(pyramidFile), "tileSize": tileSize if pyramidFile else None}
+        outputs = [outputFile]
+        if pyramidFile:
+            # Index last, so it is never there before its tiles
+            outputs += [DeepZoomPyramid(pyramidFile).getTilesFolder(), pyramidFile]
+
+        return renderCache.render([atlasMRC], params, outputs, render)
+
+    def _renderLRAtlas(self, atlasMRC, outputFile, maxSize=None, pyramidFile=None, tileSize=256):
+        """ Writes the LR atlas images. See createLRAtlas()"""
+        image = self.readMrcImage(atlasMRC, maxSize=maxSize)
+        saveAtomically(image, outputFile)
+
+        if pyramidFile:
+            DeepZoomPyramid(pyramidFile).write(image, tileSize=tileSize)
+
     @staticmethod
-    def convertMrc2Jpg(mrcfile, ouptut):
-        ih = ImageHandler()
-        ih.convert(inputObj=mrcfile, outputObj=ouptut)
+    def getTileMrcFiles(atlasFolder):
+        """ Returns the tile mrc files under the atlas folder, sorted by name so pasting order is always the same"""
+        return sorted(os.path.join(atlasFolder, file) for file in os.listdir(atlasFolder)
+                      if file.startswith("Tile") and file.endswith(".mrc"))
+
+    @classmethod
+    def getAtlasLayout(cls, atlasFolder):
+        """ Reads the placement of all the tiles of an atlas folder: dm positions and mrc headers only, no pixels
+
+        :returns AtlasLayout"""
+        tileFiles = cls.getTileMrcFiles(atlasFolder)
+        tileSizes = []
+        dmSizes = []
+        dmPositions = []
 
-    def createLRAtlas(self, atlasMRC, outputFile):
-        return self.convertMrc2Jpg(atlasMRC, outputFile)
+        for mrcFn in tileFiles:
+            mrc = MrcFile(mrcFn)
+            h, w, x, y = cls.getTileCoordinatesFromMrc(mrcFn)
+            tileSizes.append((mrc.nx, mrc.ny))
+            dmSizes.append((w, h))
+            dmPositions.append((x, y))
+
+        return AtlasLayout(tileFiles, tileSizes, dmSizes, dmPositions)
 
     @classmethod
-    def createHRAtlas(cls, atlasFolder, outputFile):
-        """ Create a full resolution atlas based on high resolution atlas mrc files"""
+    def _readTile(cls, mrcFn, tmpFolder=None):
+        """ Reads a tile mrc file as a PIL image.
+        If tmpFolder is passed, tile is converted to a jpg file there and read back, otherwise it is read in memory."""
 
-        # Get a temporary folder to work there
-        tmpFolder = tempfile.TemporaryDirectory()
-        print("Creating HR atlas at temporary folder:  %s" % tmpFolder.name)
+        if tmpFolder is None:
+            return cls.readMrcImage(mrcFn)
 
-        # Instantiate a collage object
-        collage = Collage()
+        # Compose new JPG file name
+        newJpg = os.path.basename(mrcFn) + ".jpg"
+        newJpg = os.path.join(tmpFolder, newJpg)
 
-        # Cancel compression error with large files
-        Image.MAX_IMAGE_PIXELS = None
+        # make the actual conversion
+        cls.convertMrc2Jpg(mrcFn, newJpg)
+        return Image.open(newJpg)
+
+    @classmethod
+    def _getTileSource(cls, mrc):
+        """ Returns a function reading a range of rows of a tile as 8 bits, as needed by StripCollage.
+        Tile is scaled to 8 bits with its global minimum and maximum, so rows match the whole tile conversion"""
+        data = mrc.getData()
+        minValue, maxValue = data.min(), data.max()
+
+        def source(firstRow, lastRow):
+            return cls.normalizeToUint8(data[firstRow:lastRow], minValue, maxValue)
+
+        return source
+
+    @staticmethod
+    def normalizeToUint8(data, minValue=None, maxValue=None):
+        """ Scales image data linearly to 8 bits: minimum goes to 0 and maximum to 255
+
+        :parameter data: numpy array
+        :parameter minValue: value going to 0, data minimum if None
+        :parameter maxValue: value going to 255, data maximum if None
+        :returns uint8 numpy array"""
+        data = np.array(data, dtype=np.float32)
+        minValue = data.min() if minValue is None else np.float32(minValue)
+        maxValue = data.max() if maxValue is None else np.float32(maxValue)
+        valuesRange = maxValue - minValue
+
+        data -= minValue
+        if valuesRange > 0:
+            data *= 255.0 / valuesRange
+
+        return data.astype(np.uint8)
 
-        # For each mrc file:
-        for file in os.listdir(atlasFolder):
-            # If it's an mrc file
-            if file.startswith("Tile") and file.endswith(".mrc"):
+    @classmethod
+    def mrcToImage(cls, mrc, maxSize=None):
+        """ Converts an MrcFile into an 8 bits grayscale PIL image, no intermediate files involved
+
+        :parameter mrc: MrcFile instance
+        :parameter maxSize: if passed, image is downsampled (taking one pixel every n) so its largest side is not bigger"""
+        step = 1
+        if maxSize:
+            step = int(np.ceil(max(mrc.nx, mrc.ny) / maxSize))
+
+        data = mrc.getData(step=step)
+
+        # For volumes or stacks take the first slice
+        if data.ndim == 3:
+            data = data[0]
+
+        return Image.fromarray(cls.normalizeToUint8(data), mode="L")
 
-                mrcFn = os.path.join(atlasFolder,file)
+    @classmethod
+    def readMrcImage(cls, mrcFn, maxSize=None):
+        """ Reads an mrc file in memory as an 8 bits grayscale PIL image. See mrcToImage()"""
+        return cls.mrcToImage(MrcFile(mrcFn), maxSize=maxSize)
 
-                # Convert it to jpg
-                # Compose new JPG file name
-                newJpg = os.path.basename(file) + ".jpg"
-                newJpg = os.path.join(tmpFolder.name, newJpg)
+    @classmethod
+    def createHRAtlas(cls, atlasFolder, outputFile, threads=1, useProcesses=False, inMemory=True,
+                      pyramid=False, tileSize=256, stripHeight=None, layout=None, renderCache=None):
+        """ Create a full resolution atlas based on high resolution atlas mrc files
+
+        :parameter atlasFolder: folder containing the Tile*.mrc files and its .dm files
+        :parameter outputFile: file for the full resolution atlas
+        :parameter threads: number of workers preparing the tiles concurrently
+        :parameter useProcesses: if True, workers are processes instead of threads
+        :parameter inMemory: if True tiles are read in memory, otherwise they go through temporary jpg files
+        :parameter pyramid: if True, outputFile (.dzi) will be a DeepZoom tiled pyramid instead of a single image
+        :parameter tileSize: size of the pyramid tiles
+        :parameter stripHeight: if passed, atlas is composed and written to outputFile (.pgm) in strips of this height,
+         keeping memory bounded by stripHeight * atlas width. Tiles are read from disk as each strip needs them
+        :parameter layout: AtlasLayout of the atlas folder tiles, read with getAtlasLayout() if None
+        :parameter renderCache: RenderCache to take the atlas from if tiles have not changed since it was cached
+        :returns True if the atlas came from renderCache"""
+
+        if stripHeight and pyramid:
+            raise ValueError("HR atlas in strips can't be written as a pyramid.")
+
+        render = partial(cls._renderHRAtlas, atlasFolder, outputFile, threads=threads, useProcesses=useProcesses,
+                         inMemory=inMemory, pyramid=pyramid, tileSize=tileSize, stripHeight=stripHeight,
+                         layout=layout)
+
+        if renderCache is None:
+            render()
+            return False
+
+        # Stitching options not changing the result are not part of the key
+        tileFiles = cls.getTileMrcFiles(atlasFolder)
+        sourceFiles = tileFiles + [cls.getTileFileFromMrc(tileFile) for tileFile in tileFiles]
+        params = {"render": "HRAtlas", "format": os.path.splitext(outputFile)[1].lower(),
+                  "pyramid": pyramid, "tileSize": tileSize if pyramid else None}
+        outputs = [DeepZoomPyramid(outputFile).getTilesFolder(), outputFile] if pyramid else [outputFile]
+
+        return renderCache.render(sourceFiles, params, outputs, render)
 
-                # make the actual conversion
-                EPUParser.convertMrc2Jpg(mrcFn, newJpg)
-                h,w,x,y = cls.getTileCoordinatesFromMrc(mrcFn)
+    @classmethod
+    def _renderHRAtlas(cls, atlasFolder, outputFile, threads=1, useProcesses=False, inMemory=True,
+                       pyramid=False, tileSize=256, stripHeight=None, layout=None):
+        """ Stitches the full resolution atlas. See createHRAtlas()"""
 
-                # Coordinates are scaled, I see values relative to 907 height
-                xmrc, ymrc, z, n = ImageHandler().getDimensions(mrcFn)
-                ratio = xmrc/w
+        if layout is None:
+            layout = cls.getAtlasLayout(atlasFolder)
 
-                # New coordinates using the ratio. 1 should remain 1
-                newCoordsX = 1 if x == 1 else int(x * ratio)
-                newCoordsY = 1 if y == 1 else int(y * ratio)
+        if stripHeight:
+            return cls._createHRAtlasByStrips(layout, outputFile, stripHeight)
 
-                collage.addImageFn(newJpg, (newCoordsX, newCoordsY))
+        tmpFolder = None
+        tmpFolderName = None
 
+        if not inMemory:
+            # Get a temporary folder to work there
+            tmpFolder = tempfile.TemporaryDirectory()
+            tmpFolderName = tmpFolder.name
+            print("Creating HR atlas at temporary folder:  %s" % tmpFolderName)
 
-        collage.save(outputFile)
+        # Instantiate a collage object
+        collage = Collage()
+
+        # Cancel compression error with large files
+        Image.MAX_IMAGE_PIXELS = None
+
+        readTile = partial(cls._readTile, tmpFolder=tmpFolderName)
+        coords = (coord for tileFile, coord, size in layout)
+
+        # Collage canvas is allocated once with the layout size and each tile is pasted as soon as it is read
+        if threads > 1:
+            executorClass = ProcessPoolExecutor if useProcesses else ThreadPoolExecutor
+            with executorClass(max_workers=threads) as executor:
+                # map keeps tile order, so the atlas is the same as the serial one
+                collage.addImages(zip(executor.map(readTile, layout.tileFiles), coords), size=layout.getCanvasSize())
+        else:
+            collage.addImages(zip(map(readTile, layout.tileFiles), coords), size=layout.getCanvasSize())
+
+        if pyramid:
+            DeepZoomPyramid(outputFile).write(collage.getImage(), tileSize=tileSize)
+        else:
+            collage.save(outputFile)
+
+        if tmpFolder is not None:
+            tmpFolder.cleanup()
+
+    @classmethod
+    def _createHRAtlasByStrips(cls, layout, outputFile, stripHeight):
+        """ Create the full resolution atlas as a PGM file written in horizontal strips. See createHRAtlas()"""
 
+        if not outputFile.lower().endswith(".pgm"):
+            raise ValueError("HR atlas in strips is written as PGM, %s should have .pgm extension." % outputFile)
 
+        collage = StripCollage()
 
+        # Pixels are read while composing each strip
+        for mrcFn, coord, size in layout:
+            collage.addSource(cls._getTileSource(MrcFile(mrcFn)), size, coord)
 
+        collage.save(outputFile, stripHeight=stripHeight)
@@ -25,22 +25,34 @@
 # *
 # **************************************************************************
 import datetime
+import glob
+import hashlib
 import os
+from concurrent.futures import ThreadPoolExecutor
 
-from pwem.objects import Movie, Acquisition
 from pwem.protocols import EMProtocol
 from pyworkflow.mapper.sqlite import ID
-from pyworkflow.protocol import Protocol, params, STATUS_NEW
+from pyworkflow.object import Integer
+from pyworkflow.protocol import Protocol, params, STATUS_NEW, MODE_RESTART
 from pyworkflow.utils.properties import Message
 
-from .objects import SetOfAtlasLocations
-from .parsers import EPUParser
+from . import Plugin, ATLAS_RENDER_CACHE
+from .cache import HoleLocationsCache, RenderCache
+from .mrc import MrcFile
+from .objects import AtlasLocation, SetOfAtlasLocations, selectColumns
+from .parsers import EPUParser, HOLES_CAPACITY
+from .stats import HotPathStats
+from .watcher import createFileWatcher, InotifyWatcher
 
 """
 This module will provide protocols relating cryo em atlas locations with image
 processing data
 """
 
+# Hot path statistics file, in the extra folder, and how often it is written while streaming
+STATS_FILE = "hotpath_stats.json"
+STATS_WRITE_SECS = 60
+
 
 class AtlasEPUImporter(EMProtocol):
     """ Will import atlas information and relate it to the movies"""
@@ -51,8 +63,23 @@ class AtlasEPUImporter(EMProtocol):
         Protocol.__init__(self, **kwargs)
 
         self.lastCheck = datetime.datetime.now()
-        self.lastIdSeen = 0
-        self._moviesWithSteps = []
+        # Highest input movie id with a step inserted, persisted to resume from it
+        self.lastIdSeen = Integer(0)
+        # Highest input movie id read from the input set (steps might still be pending)
+        self._lastIdFetched = None
+        self._moviesWithSteps = set()
+        # Movies waiting to complete a batch and when the first of them arrived
+        self._pendingMovies = []
+        self._pendingSince = None
+        self._watcher = None
+        self._watcherClosed = False
+        self._parser = None
+        # Atlas mrc modification time of the grids with a step generating its images
+        self._gridAtlasMTimes = {}
+        # Counters and timings of the hot paths, written to STATS_FILE
+        self._stats = HotPathStats()
+        self._lastStatsWrite = None
+        self._renderCache = None
 
     # -------------------------- DEFINE param functions ----------------------
     def _defineParams(self, form):
@@ -64,58 +91,134 @@ class AtlasEPUImporter(EMProtocol):
                       help='Protocol used to import movies. The original '
                            'path is needed to find the atlas information')
 
+        self._defineStreamingParams(form)
+        form.addParam('streamingBatchTime', params.IntParam, default=60,
+                      label='Batch time window (secs)', expertLevel=params.LEVEL_ADVANCED,
+                      help='Movies waiting to complete a batch will be processed '
+                           'anyway after this number of seconds. Use 0 to wait '
+                           'until the batch is complete or the input stream is closed.')
+        form.addParam('holesCacheSize', params.IntParam, default=HOLES_CAPACITY,
+                      label='Holes in memory', expertLevel=params.LEVEL_ADVANCED,
+                      help='Maximum number of holes coordinates kept in memory. When '
+                           'full, the holes of the least recently used grid squares are discarded.')
+        form.addParam('useFileWatcher', params.BooleanParam, default=False,
+                      label='Wake up on new files', expertLevel=params.LEVEL_ADVANCED,
+                      help='Instead of checking the input movies periodically, watch the '
+                           'input set file and the EPU metadata folders (using inotify when '
+                           'available) and look for new movies only when new data lands.')
+
+        form.addParallelSection(threads=1, mpi=0)
+
     # --------------------------- STEPS functions ------------------------------
     def _insertAllSteps(self):
 
+        # Starting from scratch (e.g. restart): output is built again with all the movies
+        if not hasattr(self, "outputAtlas") or self.runMode.get() == MODE_RESTART:
+            self.lastIdSeen.set(0)
+
+        # Checking for new input is cheap when the kernel tells about new files, so do it as often as possible.
+        # Polling watchers stat the whole metadata tree, so they keep the default interval
+        if self.useFileWatcher and isinstance(self._getWatcher(), InotifyWatcher):
+            self._stepsCheckSecs = 0
+
         # Insert processing steps
         self._insertFunctionStep('closeStreamingStep', wait=True)
 
     def closeStreamingStep(self):
         """ Close output set and generate HR resolution jpg from atlas mrc"""
 
+        # No more input to wait for
+        self._closeWatcher()
+
+        with self._stats.timer("closeStreamingStep"):
+            self._closeStreaming()
+
+        self._writeStats()
+
+    def _closeStreaming(self):
+        # Created before the threads, as the parser, so all grids share them
         parser = self._getParser()
+        self._getRenderCache()
+
+        for cacheName, stats in parser.getCacheStats().items():
+            self.info("%s cache: %s" % (cacheName, stats))
 
-        # For each of the atlas
-        for grid, atlasFn in parser.getAllAtlas():
+        # Generate the all atlas images from the mrc found at any GRID folder, one grid per thread.
+        # Those generated while streaming are skipped
+        with ThreadPoolExecutor(max_workers=max(self.numberOfThreads.get(), 1)) as executor:
+            # list raises the errors of any grid
+            list(executor.map(self._createGridAtlas, parser.getAllAtlas()))
 
-            # generate the all atlas images from the mrc found at any GRID folder
-            parser.createLRAtlas(atlasFn, self.getAtlasJpgByGrid(grid))
+    def generateGridAtlasStep(self, grid, atlasFn):
+        """ Generates the atlas images of a grid as soon as its atlas is found, while streaming"""
+        self._createGridAtlas((grid, atlasFn))
 
+    def _createGridAtlas(self, gridAtlas):
+        """ Generates the atlas images of a grid from its (grid, atlas mrc) tuple, unless they are up to date"""
+        grid, atlasFn = gridAtlas
+
+        if self._isGridAtlasUpToDate(grid, atlasFn):
+            self.info("Atlas images for %s are up to date." % grid)
+            return
+
+        cached = self._getParser().createLRAtlas(atlasFn, self.getAtlasJpgByGrid(grid),
+                                                 pyramidFile=self.getAtlasPyramidByGrid(grid),
+                                                 renderCache=self._getRenderCache())
+        self.info("Atlas images for %s %s" % (grid, "taken from the cache." if cached else "generated."))
 
     def getAtlasJpgByGrid(self, grid):
         """ returns the path of the background image (jpg) to be use as background for the viewers"""
         return self._getExtraPath(grid + "_atlas.jpg")
 
+    def _isGridAtlasUpToDate(self, grid, atlasFn):
+        """ Returns True if the grid atlas images were generated after the last change of its atlas mrc"""
+        outputs = [self.getAtlasJpgByGrid(grid), self.getAtlasPyramidByGrid(grid)]
+
+        if not all(os.path.exists(output) for output in outputs):
+            return False
+
+        return min(os.path.getmtime(output) for output in outputs) >= os.path.getmtime(atlasFn)
+
+    def getAtlasPyramidByGrid(self, grid):
+        """ returns the path of the multi resolution background (dzi) for the viewers to load only the detail needed"""
+        return self._getExtraPath(grid + "_atlas.dzi")
+
     def _getInputMovies(self):
 
         return self.importProtocol.get().outputMovies
 
-    def generateAtlasStep(self, movieDict):
+    def generateAtlasStep(self, movies):
+        """ Finds the atlas location of a batch of movies and adds them all to the output in a single commit
+        Params:
+            movies: list of (id, filename) of the movies
+        """
 
-        # Movie is a dictionary, convert it to a proper movie object
-        movie = Movie()
-        movie.setAcquisition(Acquisition())
-        movie.setAttributesFromDict(movieDict, setBasic=True,
-                                    ignoreMissing=True)
+        with self._stats.timer("generateAtlasStep"):
 
-        # Generate the output
-        outputLocations = self._getOutputSet()
+            # Generate the output
+            outputLocations = self._getOutputSet()
 
-        al = self._getAtlasInfo(movie)
-        if al is not None:
-            outputLocations.append(al)
-            outputLocations.write()
-            self._store()
+            # All the batch is located at once
+            with self._stats.timer("generateAtlasStep.locate"):
+                locations = self._getParser().getAtlasLocations([movieFn for movieId, movieFn in movies])
+                located = locations[locations['found']]
 
-    def _getAtlasInfo(self, movie):
+            for location in located:
+                al = AtlasLocation()
+                al.grid.set(location['grid'])
+                al.gridSquare.set(location['gridSquare'])
+                al.hole.set(location['hole'])
+                al.x.set(location['x'])
+                al.y.set(location['y'])
+                outputLocations.append(al)
 
-        # Get the parser
-        parser = self._getParser()
+            if len(located):
+                with self._stats.timer("generateAtlasStep.commit"):
+                    outputLocations.write()
+                    self._store()
 
-        try:
-            return parser.getAtlasLocation(movie)
-        except Exception as e:
-            print("EPU parser can't add atlas location for %s. Error: %s" % (movie.getMicName(), e))
+        self._stats.count("moviesProcessed", len(movies))
+        self._stats.count("moviesLocated", len(located))
 
     def _createSetOfAtlasLocation(self, suffix=''):
 
@@ -137,93 +240,275 @@ class AtlasEPUImporter(EMProtocol):
         localFile = self._getInputMovies().getFileName()
         now = datetime.datetime.now()
         self.lastCheck = getattr(self, 'lastCheck', now)
-        mTime = datetime.datetime.fromtimestamp(os.path.getmtime(localFile))
 
-        # If the input movies.sqlite has not changed since our last check,
-        # it does not make sense to check for new input data
-        if self.lastCheck > mTime and hasattr(self, 'listOfMovies'):
-            return None
+        if self.useFileWatcher:
+            hasNewFiles = self._hasNewFiles()
 
-        # else there are changes
-        self.lastCheck = now
+            # Grid atlases are generated as soon as they are there, no need to wait for new movies
+            if hasNewFiles:
+                self._insertNewGridAtlasSteps()
 
-        newMovieIds = self._getNewMovieIds()
+            # Nothing new has landed since our last check
+            if not hasNewFiles and not self._pendingMovies:
+                return None
+        else:
+            self._insertNewGridAtlasSteps()
 
-        if newMovieIds:
-            newSteps = self._insertNewMoviesSteps(newMovieIds)
+            mTime = datetime.datetime.fromtimestamp(os.path.getmtime(localFile))
+
+            # If the input movies.sqlite has not changed since our last check,
+            # it does not make sense to check for new input data, unless there are movies waiting
+            if self.lastCheck > mTime and hasattr(self, 'listOfMovies') and not self._pendingMovies:
+                return None
+
+        # else there are changes
+        self.lastCheck = now
 
-            if newSteps:
-                # Get the idleStep (should be the first one)
-                idleStep = self._steps[0]
-                idleStep.addPrerequisites(*newSteps)
-                self.updateSteps()
+        newMovies = self._getNewMovies()
 
         # Refresh the input (state)
         self._getInputMovies().loadAllProperties()
+        streamClosed = self._getInputMovies().isStreamClosed()
 
-        if self._getInputMovies().isStreamClosed():  # Unlock createOutputStep if finished all jobs
+        # When the stream is closed incomplete batches are processed too
+        newSteps = self._insertNewMoviesSteps(newMovies, flush=streamClosed)
+
+        if newSteps:
+            # Get the idleStep (should be the first one)
+            idleStep = self._steps[0]
+            idleStep.addPrerequisites(*newSteps)
+            self.updateSteps()
+            self._store(self.lastIdSeen)
+
+        if streamClosed:  # Unlock createOutputStep if finished all jobs
             idleStep = self._steps[0]
             if idleStep.isWaiting():
                 idleStep.setStatus(STATUS_NEW)
 
-    def _insertNewMoviesSteps(self, newMovieIds):
-        """ Insert steps to find atlas information for a movie (from streaming)
+    def _insertNewGridAtlasSteps(self):
+        """ Insert a generateGridAtlasStep for each grid atlas mrc that is new or has changed since last check """
+
+        newSteps = []
+        for grid, atlasFn in self._getParser().getAllAtlas():
+
+            # Atlas might not be there yet or still being written
+            if not os.path.exists(atlasFn):
+                continue
+
+            mTime = os.path.getmtime(atlasFn)
+            if self._gridAtlasMTimes.get(grid) == mTime or not self._isMrcComplete(atlasFn):
+                continue
+
+            self._gridAtlasMTimes[grid] = mTime
+            newSteps.append(self._insertFunctionStep('generateGridAtlasStep', grid, atlasFn,
+                                                     prerequisites=[]))
+
+        if newSteps:
+            # closeStreamingStep (first one) waits for them
+            self._steps[0].addPrerequisites(*newSteps)
+            self.updateSteps()
+
+        return newSteps
+
+    @staticmethod
+    def _isMrcComplete(mrcFn):
+        """ Returns True if the mrc file has been fully written """
+        try:
+            return MrcFile(mrcFn).isComplete()
+        except ValueError:
+            # Header not written yet
+            return False
+
+    def _insertNewMoviesSteps(self, newMovies, flush=False):
+        """ Insert steps to find atlas information for movies (from streaming), grouped in batches
         Params:
-            inputMovies: input movies set to be check
+            newMovies: (id, filename) of the new movies in the input set
+            flush: if True, movies not completing a batch are inserted too
         """
 
+        # Movies are queued until they complete a batch
+        for movieId, movieFn in newMovies:
+            self._addPendingMovie(movieId, movieFn)
+
+        return self._insertPendingMoviesSteps(flush)
+
+    def _addPendingMovie(self, movieId, movieFn):
+        """ Queues a movie to be processed in the next batch """
+
+        if movieId not in self._moviesWithSteps:
+
+            if not self._pendingMovies:
+                self._pendingSince = datetime.datetime.now()
+
+            self._pendingMovies.append((movieId, movieFn))
+            self._moviesWithSteps.add(movieId)
+
+    def _isBatchTimeExpired(self):
+        """ Returns True if pending movies have been waiting longer than the batch time window """
+        timeWindow = self.getAttributeValue('streamingBatchTime', 0)
+
+        if not timeWindow or self._pendingSince is None:
+            return False
+
+        return (datetime.datetime.now() - self._pendingSince).total_seconds() >= timeWindow
+
+    def _insertPendingMoviesSteps(self, flush=False):
+        """ Insert a generateAtlasStep per batch of pending movies.
+        Incomplete batches are kept unless flush is True or they have waited too long. """
+
+        batchSize = self._getStreamingBatchSize()
+        flush = flush or self._isBatchTimeExpired()
+
+        if batchSize == 0:  # Greedy, take all available ones
+            batchSize = len(self._pendingMovies)
+
         steps = []
-        # For each movie insert the step to process it
-        for movieId in newMovieIds:
-            movie = self._getInputMovies()[movieId]
-            newStep = self._insertMovieStep(movie)
-            if newStep:
-                steps.append(newStep)
+        while self._pendingMovies and (len(self._pendingMovies) >= batchSize or flush):
+            batch = self._pendingMovies[:batchSize]
+            del self._pendingMovies[:batchSize]
+            steps.append(self._insertMoviesStep(batch))
+
+            # Movies come sorted by id, so all up to this one have a step
+            self.lastIdSeen.set(batch[-1][0])
+
+        if not self._pendingMovies:
+            self._pendingSince = None
+
         return steps
 
-    def _insertMovieStep(self, movie):
+    def _insertMoviesStep(self, movieDicts):
+        """ Insert the generateAtlasStep for a batch of movies. """
+        return self._insertFunctionStep('generateAtlasStep',
+                                        movieDicts, prerequisites=[])
+
+    def _getNewMovies(self):
+        """ Returns (id, filename) of the movies added to the input set since last check.
+        Only rows added since then are read, in a single query and without building movie objects. """
+
+        with self._stats.timer("_getNewMovies"):
+            # Resume from the last movie with a step (e.g. after a restart)
+            if self._lastIdFetched is None:
+                self._lastIdFetched = self.lastIdSeen.get()
+
+            newMovies = [(row[0], row[1]) for row in
+                         selectColumns(self._getInputMovies(), [ID, '_filename'], minId=self._lastIdFetched)]
 
-        """ Insert the processMovieStep for a given movie. """
+            if newMovies:
+                self._lastIdFetched = newMovies[-1][0]
 
-        # Get the movie Id
-        objId = movie.getObjId()
+        self._stats.count("newMovies", len(newMovies))
+        return newMovies
 
-        if objId not in self._moviesWithSteps:
+    def _hasNewFiles(self):
+        """ Returns True if the input set or the EPU metadata have changed since last call (always True the first time)"""
 
-            movieDict = movie.getObjDict(includeBasic=True)
-            movieStepId = self._insertFunctionStep('generateAtlasStep',
-                                               movieDict, prerequisites=[])
-            self._moviesWithSteps.append(movie.getObjId())
-            return movieStepId
+        # Closed by closeStreamingStep: nothing else will come
+        if self._watcherClosed:
+            return False
 
-    def _getNewMovieIds(self):
-        """ Load the input set of movies and create a list. """
+        inputFn = self._getInputMovies().getFileName()
+        if not self._getWatcher().isWatching(inputFn):
+            self._watcher.watch(inputFn)
+            self._watcher.watch(self._getParser()._getCommonPathToAllGrids())
+            self._watchGridsMetadata()
+            return True
 
-        movies = self._getInputMovies()
-        newIds = []
+        changed = self._watcher.hasChanged()
 
-        # NOTE:  I'm intentionally here accessing the db object since there is
-        # no method to just get the ids in the mapper or set with a where
-        whereStr = "%s > %i" % (ID, self.lastIdSeen)
+        # New grids might have appeared
+        if changed:
+            self._watchGridsMetadata()
 
-        mapper = movies._getMapper()
-        rows = mapper.db.selectObjectsWhere(whereStr)
+        return changed
 
-        for row in rows:
+    def _getWatcher(self):
+        """ Returns the file watcher, created once """
+        if self._watcher is None:
+            self._watcher = createFileWatcher()
 
-            newIds.append(row[ID])
+        return self._watcher
 
-        return newIds
+    def _closeWatcher(self):
+        """ Releases the file watcher (inotify file descriptor) """
+        if self._watcher is not None:
+            self._watcher.close()
+            self._watcher = None
+        self._watcherClosed = True
+
+    def _watchGridsMetadata(self):
+        """ Watches the metadata folder tree and the atlas folder of all grids """
+        for grid, gridFolder in self._getParser().getAllGRIDFolders():
+            metadataFolder = EPUParser._getMetadataFolderFn(gridFolder)
+            if os.path.isdir(metadataFolder) and not self._watcher.isWatching(metadataFolder):
+                self._watcher.watch(metadataFolder, recursive=True)
+
+            atlasFolder = EPUParser._getAtlasFolderFn(gridFolder)
+            if os.path.isdir(atlasFolder) and not self._watcher.isWatching(atlasFolder):
+                self._watcher.watch(atlasFolder)
 
     def _stepsCheck(self):
         # Input movie set can be loaded or None when checked for new inputs
         # If None, we load it
 
-        self._checkNewInput()
+        with self._stats.timer("_checkNewInput"):
+            self._checkNewInput()
+
+        # Write the statistics now and then, to see how a running protocol is doing
+        now = datetime.datetime.now()
+        if self._lastStatsWrite is None or (now - self._lastStatsWrite).total_seconds() >= STATS_WRITE_SECS:
+            self._writeStats()
+            self._lastStatsWrite = now
 
     # -------------------------- Helper functions ------------------------------
     def _getParser(self):
-        return  EPUParser(self.importProtocol.get().filesPath.get())
+        """ Returns the parser, created once so its caches are reused by all steps """
+        if self._parser is None:
+            self._parser = EPUParser(self.importProtocol.get().filesPath.get(),
+                                     holesCapacity=self.getAttributeValue('holesCacheSize', HOLES_CAPACITY),
+                                     stats=self._stats)
+            self._parser.setHolesCache(self._getHolesCache(self._parser._getCommonPathToAllGrids()))
+
+        return self._parser
+
+    def _getRenderCache(self):
+        """ Returns the cache of rendered atlas images, shared by all the protocols of the project by default """
+        if self._renderCache is None:
+            cacheFolder = Plugin.getVar(ATLAS_RENDER_CACHE)
+            if not cacheFolder:
+                projectFolder = os.path.dirname(os.path.dirname(self.getWorkingDir()))
+                cacheFolder = os.path.join(projectFolder, "Tmp", "atlas_render_cache")
+            self._renderCache = RenderCache(cacheFolder)
+
+        return self._renderCache
+
+    def _getHolesCache(self, epuPath):
+        """ Returns the persistent holes coordinates cache for the EPU session at epuPath.
+        When created, it is filled with the caches of other protocols of the project reading the same session """
+        epuId = hashlib.md5(os.path.realpath(epuPath).encode()).hexdigest()[:10]
+        cacheName = "holes_%s.sqlite" % epuId
+        cacheFn = self._getExtraPath(cacheName)
+        isNew = not os.path.exists(cacheFn)
+
+        holesCache = HoleLocationsCache(cacheFn)
+
+        if isNew:
+            runsFolder = os.path.dirname(self.getWorkingDir())
+            for siblingCacheFn in glob.glob(os.path.join(runsFolder, "*", "extra", cacheName)):
+                holesCache.importFrom(siblingCacheFn)
+
+        return holesCache
+
+    def getStatsFile(self):
+        """ Returns the json file with the hot path statistics of the protocol"""
+        return self._getExtraPath(STATS_FILE)
+
+    def _writeStats(self):
+        """ Writes the hot path statistics, adding the parser in memory caches ones """
+        for cacheName, stats in self._getParser().getCacheStats().items():
+            for statName in ("hits", "misses", "evictions"):
+                self._stats.setCounter("%sCache.%s" % (cacheName, statName), stats[statName])
+
+        self._stats.write(self.getStatsFile())
 
     # -------------------------- INFO functions --------------------------------
     def _summary(self):
@@ -234,8 +519,27 @@ class AtlasEPUImporter(EMProtocol):
 
             summary.append("This protocol has associated movies with its"
                            " acquisition location.")
+
+        stats = HotPathStats.read(self.getStatsFile())
+        if stats:
+            summary.append(self._getThroughputLine(stats))
+
         return summary
 
+    @staticmethod
+    def _getThroughputLine(stats):
+        """ Returns a summary line with the movies located per second from the hot path statistics """
+        counters = stats["counters"]
+        steps = stats["latencies"].get("generateAtlasStep", {})
+        checks = stats["latencies"].get("_checkNewInput", {})
+        stepsTime = steps.get("total", 0)
+
+        return ("Located %d of %d movies in %.1f s of processing (%.1f movies/s). "
+                "Input checked %d times, %.1f ms on average."
+                % (counters.get("moviesLocated", 0), counters.get("moviesProcessed", 0), stepsTime,
+                   counters.get("moviesProcessed", 0) / stepsTime if stepsTime else 0,
+                   checks.get("count", 0), checks.get("mean", 0) * 1000))
+
     def _methods(self):
         methods = []
 
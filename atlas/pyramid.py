@@ -0,0 +1,169 @@
+# **************************************************************************
+# *
+# * Authors:   Pablo Conesa       (pconesa@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+import math
+import os
+import xml.etree.ElementTree as ET
+
+from PIL import Image
+
+DZI_NAMESPACE = "http://schemas.microsoft.com/deepzoom/2008"
+DZI_EXTENSION = ".dzi"
+
+
+class DeepZoomPyramid:
+    """ Multi resolution tiled image following DeepZoom layout:
+
+    - <name>.dzi: small xml index with the full size, tile size and tile format
+    - <name>_files/<level>/<column>_<row>.<format>: fixed size tiles for each level
+
+    Level 0 is a 1x1 pixel image and each level doubles the previous one up to the
+    last level, which is the full resolution image. Viewers can then read only the
+    level and tiles they need."""
+
+    def __init__(self, dziFile):
+        self.dziFile = dziFile
+        self.width = None
+        self.height = None
+        self.tileSize = None
+        self.format = None
+
+    @classmethod
+    def load(cls, dziFile):
+        """ Returns a pyramid reading its dimensions from an existing dzi file"""
+        pyramid = cls(dziFile)
+        root = ET.parse(dziFile).getroot()
+
+        pyramid.tileSize = int(root.get("TileSize"))
+        pyramid.format = root.get("Format")
+
+        for element in root:
+            if element.tag.endswith("Size"):
+                pyramid.width = int(element.get("Width"))
+                pyramid.height = int(element.get("Height"))
+
+        return pyramid
+
+    def getTilesFolder(self):
+        """ Returns the folder containing a subfolder per level"""
+        return os.path.splitext(self.dziFile)[0] + "_files"
+
+    def getTileFn(self, level, column, row):
+        """ Returns the file of a tile"""
+        return os.path.join(self.getTilesFolder(), str(level), "%s_%s.%s" % (column, row, self.format))
+
+    def getSize(self):
+        """ Returns width, height of the full resolution image"""
+        return self.width, self.height
+
+    def getMaxLevel(self):
+        """ Returns the full resolution level"""
+        return int(math.ceil(math.log2(max(self.width, self.height, 1))))
+
+    def getLevelSize(self, level):
+        """ Returns width, height of the image at a level"""
+        scale = 2 ** (self.getMaxLevel() - level)
+        return int(math.ceil(self.width / scale)), int(math.ceil(self.height / scale))
+
+    def getLevelTiles(self, level):
+        """ Returns number of columns and rows of tiles of a level"""
+        width, height = self.getLevelSize(level)
+        return int(math.ceil(width / self.tileSize)), int(math.ceil(height / self.tileSize))
+
+    def getLevelForSize(self, size):
+        """ Returns the lowest level whose largest side is at least size pixels (or the max level)"""
+        level = int(math.ceil(math.log2(max(size, 1))))
+        return min(level, self.getMaxLevel())
+
+    def write(self, image, tileSize=256, tileFormat="jpg"):
+        """ Writes the pyramid from a PIL image: tiles of all levels and the dzi index
+
+        :parameter image: full resolution PIL image
+        :parameter tileSize: size of the tiles side
+        :parameter tileFormat: PIL format extension for the tiles"""
+
+        self.width, self.height = image.size
+        self.tileSize = tileSize
+        self.format = tileFormat
+
+        # From full resolution down to 1 pixel, halving the previous level each time
+        levelImage = image
+        for level in range(self.getMaxLevel(), -1, -1):
+            levelSize = self.getLevelSize(level)
+            if levelImage.size != levelSize:
+                levelImage = levelImage.resize(levelSize, Image.BILINEAR)
+
+            self._writeLevel(levelImage, level)
+
+        self._writeIndex()
+
+    def _writeLevel(self, levelImage, level):
+        """ Splits the level image in tiles and writes them"""
+        os.makedirs(os.path.join(self.getTilesFolder(), str(level)), exist_ok=True)
+        columns, rows = self.getLevelTiles(level)
+        width, height = levelImage.size
+
+        for column in range(columns):
+            for row in range(rows):
+                x = column * self.tileSize
+                y = row * self.tileSize
+                box = (x, y, min(x + self.tileSize, width), min(y + self.tileSize, height))
+                levelImage.crop(box).save(self.getTileFn(level, column, row))
+
+    def _writeIndex(self):
+        """ Writes the dzi xml file"""
+        root = ET.Element("Image", {"xmlns": DZI_NAMESPACE,
+                                    "TileSize": str(self.tileSize),
+                                    "Overlap": "0",
+                                    "Format": self.format})
+        ET.SubElement(root, "Size", {"Width": str(self.width), "Height": str(self.height)})
+        # Written last and renamed, so readers never find an index of missing or incomplete tiles
+        tmpFile = self.dziFile + ".tmp"
+        ET.ElementTree(root).write(tmpFile, encoding="UTF-8", xml_declaration=True)
+        os.replace(tmpFile, self.dziFile)
+
+    def getTile(self, level, column, row):
+        """ Returns a tile as PIL image"""
+        return Image.open(self.getTileFn(level, column, row))
+
+    def getRegion(self, level, box=None):
+        """ Returns a PIL image of a region of a level reading only the tiles covering it
+
+        :parameter level: level to read from
+        :parameter box: (left, upper, right, lower) in level pixels. Whole level if None"""
+        width, height = self.getLevelSize(level)
+        left, upper, right, lower = box if box is not None else (0, 0, width, height)
+        left, upper = max(left, 0), max(upper, 0)
+        right, lower = min(right, width), min(lower, height)
+
+        region = None
+        for column in range(left // self.tileSize, (right - 1) // self.tileSize + 1):
+            for row in range(upper // self.tileSize, (lower - 1) // self.tileSize + 1):
+                tile = self.getTile(level, column, row)
+                if region is None:
+                    region = Image.new(tile.mode, (right - left, lower - upper))
+                region.paste(tile, (column * self.tileSize - left, row * self.tileSize - upper))
+
+        return region
@@ -0,0 +1,140 @@
+# **************************************************************************
+# *
+# * Authors:   Pablo Conesa       (pconesa@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+import bisect
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# Upper bounds (seconds) of the latency histogram buckets: 0.1 ms doubling up to ~52 s. Last bucket is for slower ones
+LATENCY_BOUNDS = tuple(0.0001 * 2 ** exponent for exponent in range(20))
+
+
+class LatencyHistogram:
+    """ Count, total, maximum and log scale histogram of the durations of an operation"""
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = [0] * (len(LATENCY_BOUNDS) + 1)
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        self.buckets[bisect.bisect_left(LATENCY_BOUNDS, seconds)] += 1
+
+    def getPercentile(self, percentile):
+        """ Returns the upper bound of the bucket holding the percentile (0-100), an upper estimate of it"""
+        if not self.count:
+            return 0.0
+
+        rank = self.count * percentile / 100.0
+        accumulated = 0
+        for bound, bucketCount in zip(LATENCY_BOUNDS, self.buckets):
+            accumulated += bucketCount
+            if accumulated >= rank:
+                return min(bound, self.max)
+
+        return self.max
+
+    def toDict(self):
+        return {"count": self.count,
+                "total": self.total,
+                "mean": self.total / self.count if self.count else 0.0,
+                "max": self.max,
+                "p50": self.getPercentile(50),
+                "p95": self.getPercentile(95),
+                "p99": self.getPercentile(99),
+                "buckets": {"%g" % bound: bucketCount
+                            for bound, bucketCount in zip(LATENCY_BOUNDS + (float("inf"),), self.buckets)
+                            if bucketCount}}
+
+
+class HotPathStats:
+    """ Thread safe counters and latency histograms of the operations of a protocol, that can be written
+    to a json file to find out where the time goes"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._latencies = {}
+        self.started = time.time()
+
+    def count(self, name, increment=1):
+        """ Adds increment to a counter"""
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + increment
+
+    def setCounter(self, name, value):
+        """ Sets a counter, for values counted elsewhere"""
+        with self._lock:
+            self._counters[name] = value
+
+    def addTime(self, name, seconds):
+        """ Adds a duration to the latency histogram of an operation"""
+        with self._lock:
+            histogram = self._latencies.get(name)
+            if histogram is None:
+                histogram = self._latencies[name] = LatencyHistogram()
+            histogram.add(seconds)
+
+    @contextmanager
+    def timer(self, name):
+        """ Context manager adding the duration of its block to the latency histogram of name"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.addTime(name, time.perf_counter() - start)
+
+    def getCounter(self, name):
+        return self._counters.get(name, 0)
+
+    def toDict(self):
+        with self._lock:
+            return {"started": self.started,
+                    "elapsed": time.time() - self.started,
+                    "counters": dict(self._counters),
+                    "latencies": {name: histogram.toDict() for name, histogram in self._latencies.items()}}
+
+    def write(self, jsonFile):
+        """ Writes the statistics to a json file, replacing it at once so readers never find it half written"""
+        tmpFile = jsonFile + ".tmp"
+        with open(tmpFile, "w") as f:
+            json.dump(self.toDict(), f, indent=2, sort_keys=True)
+        os.replace(tmpFile, jsonFile)
+
+    @staticmethod
+    def read(jsonFile):
+        """ Returns the dictionary written by write(), or None if there is no file"""
+        if not os.path.exists(jsonFile):
+            return None
+
+        with open(jsonFile) as f:
+            return json.load(f)
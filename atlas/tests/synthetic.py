@@ -0,0 +1,155 @@
+# **************************************************************************
+# *
+# * Authors:   Pablo Conesa       (pconesa@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Synthetic EPU sessions, to test and benchmark the plugin without downloading data:
+
+<root>/GRID_XX/ATLAS/Atlas_1.mrc, Tile_*.mrc and Tile_*.dm
+<root>/GRID_XX/DATA/Metadata/GridSquare_*/TargetLocation_*.dm
+"""
+import os
+
+import numpy as np
+
+from ..parsers import GRID_, GRIDSQUARE_MD, TARGET_LOCATION_FILE_PATTERN, EPUParser
+
+MRC_STAMP = b"MAP DA\x00\x00"
+
+TILE_DM = ('<MicroscopeImage xmlns="http://schemas.datacontract.org/2004/07/Fei.SharedObjects">'
+           '<AtlasPixelPosition xmlns:a="http://schemas.datacontract.org/2004/07/System.Drawing">'
+           '<a:height>%d</a:height><a:width>%d</a:width><a:x>%d</a:x><a:y>%d</a:y>'
+           '</AtlasPixelPosition></MicroscopeImage>')
+
+TARGET_LOCATION_DM = ('<TargetLocation xmlns="http://schemas.datacontract.org/2004/07/Applications.Epu.Persistence">'
+                      '<StagePosition xmlns:a="http://schemas.datacontract.org/2004/07/Fei.Types">'
+                      '<a:A>0</a:A><a:B>0</a:B><a:X>%r</a:X><a:Y>%r</a:Y><a:Z>0</a:Z></StagePosition>'
+                      '%s</TargetLocation>')
+
+# Tiles in the atlas dm files are placed in a canvas of this size
+ATLAS_DM_SIZE = 907
+
+
+def writeMrc(mrcFn, data):
+    """ Writes a 2D numpy array as a float32 mrc file"""
+    header = np.zeros(256, dtype=np.int32)
+    header[0:4] = (data.shape[1], data.shape[0], 1, 2)
+    header = header.tobytes()
+    header = header[:208] + MRC_STAMP + header[216:]
+
+    with open(mrcFn, "wb") as f:
+        f.write(header)
+        f.write(data.astype(np.float32).tobytes())
+
+
+class SyntheticEPUSession:
+    """ Writes an EPU like folder tree with random images and locations
+
+    :parameter root: folder to write the session in
+    :parameter grids: number of GRID_XX folders
+    :parameter tilesPerSide: atlas tiles are a tilesPerSide x tilesPerSide mosaic
+    :parameter tileSize: side of the tiles in pixels
+    :parameter gridSquares: grid squares per grid
+    :parameter holes: holes (TargetLocation files) per grid square. Hole ids are unique in the session, as in EPU
+    :parameter dmPadding: characters of filler in the TargetLocation files, real ones are a few KB"""
+
+    def __init__(self, root, grids=1, tilesPerSide=3, tileSize=256, gridSquares=2, holes=100, dmPadding=3000,
+                 seed=0):
+        self.root = root
+        self.grids = ["%02d" % (grid + 1) for grid in range(grids)]
+        self.tilesPerSide = tilesPerSide
+        self.tileSize = tileSize
+        self.gridSquares = [str(1000000 + gridSquare) for gridSquare in range(gridSquares)]
+        self.holes = holes
+        self.dmPadding = dmPadding
+        self._random = np.random.default_rng(seed)
+
+    def getImportPath(self):
+        """ Returns the import path as the import movies protocol would have it"""
+        return os.path.join(self.root, GRID_ + "??", "DATA", "Images-Disc1", GRIDSQUARE_MD + "*", "Data")
+
+    def getGridFolder(self, grid):
+        return os.path.join(self.root, GRID_ + grid)
+
+    def getAtlasFolder(self, grid):
+        return EPUParser._getAtlasFolderFn(self.getGridFolder(grid))
+
+    def getMovieFileNames(self):
+        """ Returns a movie file name for every hole, named as the import protocol links them"""
+        return ["%s%s_DATA_Images-Disc1_%s%s_DATA_FoilHole_%s_Data_1_2_20200101_000000_Fractions.mrc"
+                % (GRID_, grid, GRIDSQUARE_MD, gridSquare, hole)
+                for grid in self.grids for gridSquare in self.gridSquares for hole in self.getHoles(grid, gridSquare)]
+
+    def getHoles(self, grid, gridSquare):
+        """ Returns the hole ids of a grid square"""
+        first = 2000000 + (self.grids.index(grid) * len(self.gridSquares)
+                           + self.gridSquares.index(gridSquare)) * self.holes
+        return [str(first + hole) for hole in range(self.holes)]
+
+    def getStagePosition(self, grid, gridSquare, hole):
+        """ Returns the x, y written in the TargetLocation file of a hole"""
+        return int(grid) * 1e-4 + int(hole) * 1e-8, int(gridSquare) * 1e-10
+
+    def write(self):
+        """ Writes all the session files"""
+        for grid in self.grids:
+            self.writeAtlas(grid)
+            self.writeMetadata(grid)
+
+        return self
+
+    def writeAtlas(self, grid):
+        """ Writes the atlas tiles, its dm files and Atlas_1.mrc of a grid"""
+        atlasFolder = self.getAtlasFolder(grid)
+        os.makedirs(atlasFolder, exist_ok=True)
+
+        # Tiles overlap a bit, as real ones do
+        dmStep = ATLAS_DM_SIZE // self.tilesPerSide
+        for row in range(self.tilesPerSide):
+            for column in range(self.tilesPerSide):
+                tileFn = os.path.join(atlasFolder, "Tile_%d_%d_%d" % (1000000 + row * self.tilesPerSide + column,
+                                                                      row, column))
+                writeMrc(tileFn + ".mrc", self._random.normal(size=(self.tileSize, self.tileSize)) * 100)
+
+                x = 1 if column == 0 else column * dmStep - 2
+                y = 1 if row == 0 else row * dmStep - 2
+                with open(tileFn + ".dm", "w") as f:
+                    f.write(TILE_DM % (dmStep, dmStep, x, y))
+
+        writeMrc(EPUParser._getAtlasMrcImageFn(atlasFolder),
+                 self._random.normal(size=(self.tileSize, self.tileSize)) * 100)
+
+    def writeMetadata(self, grid):
+        """ Writes a TargetLocation dm file for every hole of every grid square of a grid"""
+        padding = "<Padding>%s</Padding>" % ("x" * self.dmPadding)
+
+        for gridSquare in self.gridSquares:
+            gridSquareFolder = os.path.join(EPUParser._getMetadataFolderFn(self.getGridFolder(grid)),
+                                            GRIDSQUARE_MD + gridSquare)
+            os.makedirs(gridSquareFolder, exist_ok=True)
+
+            for hole in self.getHoles(grid, gridSquare):
+                x, y = self.getStagePosition(grid, gridSquare, hole)
+                with open(os.path.join(gridSquareFolder, TARGET_LOCATION_FILE_PATTERN % hole), "w") as f:
+                    f.write(TARGET_LOCATION_DM % (x, y, padding))
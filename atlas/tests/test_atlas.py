@@ -23,21 +23,38 @@
 # *  e-mail address 'scipion@cnb.csic.es'
 # *
 # **************************************************************************
+import datetime
+import gc
 import os
 import tempfile
+import time
+import xml.etree.ElementTree as ET
 
+import numpy as np
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
 from PIL import Image
-from atlas.collage import Collage
-from pwem.objects import Movie, Pointer
+from atlas.cache import HoleLocationsCache, LRUCache, RenderCache
+from atlas.collage import Collage, StripCollage
+from atlas.layout import AtlasLayout
+from atlas.mrc import MrcFile
+from atlas.pyramid import DeepZoomPyramid
+from atlas.stats import HotPathStats
+from atlas.watcher import createFileWatcher, PollingWatcher
+from pwem.objects import Movie, Pointer, SetOfMovies
 from pwem.protocols import ProtImportMovies
+from pyworkflow.mapper.sqlite import ID
 from pyworkflow.tests import BaseTest, DataSet, setupTestProject
 
-from ..parsers import EPUParser, GRID_, GRIDSQUARE_MD, \
-    TARGET_LOCATION_FILE_PATTERN
+from ..parsers import EPUParser, GridSquareIndex, EPUSessionIndex, GRID_, GRIDSQUARE_MD, \
+    TARGET_LOCATION_FILE_PATTERN, iterDmChildren, saveAtomically
 
 
 # Define new dataset here
+from ..objects import selectColumns
 from ..protocols import AtlasEPUImporter
+from ..viewers import AtlasImporterViewer
+from .synthetic import SyntheticEPUSession, TARGET_LOCATION_DM, writeMrc
 
 class DSKeys:
     ROOT = 'root'
@@ -95,6 +112,65 @@ class TestAtlas(BaseTest):
 
         # Test what the low res atlas (mrc to jpg 4096x4096) has been produced
         self.assertTrue(os.path.exists(atlasProt._getExtraPath("GRID05_atlas.jpg")))
+        stats = HotPathStats.read(atlasProt.getStatsFile())
+        self.assertEqual(atlasProt.outputAtlas.getSize(), stats["counters"]["moviesLocated"],
+                         "Hot path statistics do not count the located movies")
+
+        pyramid = DeepZoomPyramid.load(atlasProt.getAtlasPyramidByGrid("GRID05"))
+        self.assertEqual(Image.open(atlasProt._getExtraPath("GRID05_atlas.jpg")).size, pyramid.getSize(),
+                         "Atlas pyramid size does not match the low res atlas")
+
+        # Viewer data, read in columns, matches the set items
+        viewer = AtlasImporterViewer(project=self.proj, protocol=atlasProt)
+        grids = viewer._getData(atlasProt.outputAtlas)
+        for atlasLoc in atlasProt.outputAtlas.iterItems():
+            self.assertIn(AtlasImporterViewer.convertUnits(atlasLoc.x.get()), grids[atlasLoc.grid.get()][0],
+                          "Location x missing in viewer data")
+
+    def test_viewer_density(self):
+
+        x = np.array([0., 1., 1., 10.])
+        y = np.array([0., 1., 1., 5.])
+        density, extent = AtlasImporterViewer.getDensity(x, y, bins=10)
+
+        self.assertEqual(4, density.sum(), "Density does not count all the locations")
+        self.assertEqual(2, density.max(), "Locations in the same bin not added")
+        self.assertTrue(extent[0] <= 0 and extent[1] >= 10 and extent[2] <= 0 and extent[3] >= 5,
+                        "Density extent does not cover the locations")
+
+    def test_viewer_group_by_grid(self):
+
+        grids = AtlasImporterViewer.groupByGrid(np.array(["05", "02", "05", "02", "07"]),
+                                                np.arange(5.), np.arange(5.) * 10)
+
+        self.assertEqual(["02", "05", "07"], sorted(grids.keys()), "Wrong grids")
+        self.assertEqual([1., 3.], list(grids["02"][0]), "Wrong x for grid 02")
+        self.assertEqual([0., 20.], list(grids["05"][1]), "Wrong y for grid 05")
+
+    def test_viewer_zoom_detail(self):
+        """ Zooming in the atlas background loads the visible region in more detail, once loadAtlasImg has returned"""
+        dziFn = os.path.join(tempfile.mkdtemp(), "atlas.dzi")
+        DeepZoomPyramid(dziFn).write(Image.fromarray(np.random.randint(0, 255, (2048, 2048), dtype=np.uint8)))
+
+        viewer = AtlasImporterViewer(project=self.proj)
+        viewer.getAtlasImagePath = lambda grid: None
+        viewer.getAtlasPyramidPath = lambda grid: dziFn
+
+        figure = Figure(figsize=(2, 2))
+        canvas = FigureCanvasAgg(figure)
+        axes = figure.add_subplot()
+        viewer.loadAtlasImg(axes, "01")
+        gc.collect()
+        canvas.draw()
+        images = len(axes.images)
+
+        left, right = axes.get_xlim()
+        bottom, top = axes.get_ylim()
+        axes.set_xlim(left, left + (right - left) / 20)
+        axes.set_ylim(bottom, bottom + (top - bottom) / 20)
+        canvas.draw()
+
+        self.assertEqual(images + 1, len(axes.images), "Zoomed region not loaded")
 
 
     def test_FEIParser(self):
@@ -117,11 +193,12 @@ class TestAtlas(BaseTest):
         x = atlasLoc.x.get()
         y = atlasLoc.y.get()
 
-        self.assertEqual(len(epuParser._holesLocations), 1, "Hole location not cached")
+        holesInMemory = epuParser.getCacheStats()["holes"]["size"]
+        self.assertTrue(holesInMemory >= 1, "Hole location not cached")
 
         atlasLoc = epuParser.getAtlasLocation(movie)
 
-        self.assertEqual(len(epuParser._holesLocations), 1, "Hole location wrongly increased")
+        self.assertEqual(holesInMemory, epuParser.getCacheStats()["holes"]["size"], "Holes in memory wrongly increased")
         self.assertEqual(atlasLoc.x.get(), x, "X value does not match")
         self.assertEqual(atlasLoc.y.get(), y, "Y value does not match")
 
@@ -150,6 +227,12 @@ class TestAtlas(BaseTest):
         grids = list(epuParser.getAllGRIDFolders())
         self.assertEqual(1, len(grids), "getAllGRIDFolders does not return 1 item")
 
+        # Batch version
+        locations = epuParser.getAtlasLocations([movie.getFileName(), "no_ids_movie.mrc"])
+        self.assertEqual(2, len(locations), "Batch atlas locations does not return a row per movie")
+        self.assertEqual(("05", "1818577", "1821393", x, y, True), locations[0].item(), "Wrong batch atlas location")
+        self.assertFalse(locations[1]['found'], "Location found for a movie without ids")
+
 
     def test_collage(self):
         """ Tests basic collage composition"""
@@ -205,6 +288,51 @@ class TestAtlas(BaseTest):
         img = Image.open(collageFn)
         self.assertEqual((3,3), img.size, "Wrong collage size when using 2 2x2 PIL images with coordinates")
 
+    def test_collage_add_images(self):
+        """ Tests collage composition in one go gives the same result as the incremental one"""
+        placements = [(Image.new(mode="L", size=(2, 2), color=255), (1, 1)),
+                      (Image.new(mode="L", size=(3, 2), color=200), (2, 0)),
+                      (Image.new(mode="L", size=(2, 2), color=100), None),
+                      (Image.new(mode="L", size=(2, 3), color=50), (1, 2))]
+
+        incremental = Collage()
+        for img, coord in placements:
+            incremental.addImage(img, coord)
+
+        collage = Collage()
+        collage.addImages(placements)
+
+        self.assertEqual(incremental.getSize(), collage.getSize(), "Collage size differs from the incremental one")
+        self.assertEqual(incremental.getNextCoord(), collage.getNextCoord(), "Next coordinate differs from the incremental one")
+        self.assertEqual(incremental._image.tobytes(), collage._image.tobytes(), "Collage pixels differ from the incremental ones")
+
+        # Knowing the size, images are pasted as they come
+        streamed = Collage()
+        streamed.addImages((placement for placement in placements), size=incremental.getSize())
+        self.assertEqual(incremental._image.tobytes(), streamed._image.tobytes(), "Streamed collage pixels differ")
+
+    def test_strip_collage(self):
+        """ Tests collage composed in strips gives the same result as the in memory one"""
+        placements = [(Image.new(mode="L", size=(2, 2), color=255), (1, 1)),
+                      (Image.new(mode="L", size=(3, 2), color=200), (2, 0)),
+                      (Image.new(mode="L", size=(2, 3), color=50), (1, 2))]
+
+        collage = Collage()
+        collage.addImages(placements)
+
+        stripCollage = StripCollage()
+        for img, coord in placements:
+            stripCollage.addImage(img, coord)
+
+        self.assertEqual(collage.getSize(), stripCollage.getSize(), "Strip collage size differs from the in memory one")
+
+        # Get a temporary filename
+        collageFn = tempfile.NamedTemporaryFile(suffix=".pgm", delete=False)
+        stripCollage.save(collageFn.name, stripHeight=2)
+
+        img = Image.open(collageFn.name)
+        self.assertEqual(collage.getImage().tobytes(), img.tobytes(), "Strip collage pixels differ from the in memory ones")
+
     def test_collage_with_tiles(self):
 
         collage = Collage()
@@ -256,4 +384,501 @@ class TestAtlas(BaseTest):
         ratio = 4096/907
         expectedDimensions = int(3184 * ratio) + 4096
 
-        self.assertEqual((expectedDimensions, expectedDimensions), img.size, "Wrong collage size when using atlas jpg as tiles")
\ No newline at end of file
+        self.assertEqual((expectedDimensions, expectedDimensions), img.size, "Wrong collage size when using atlas jpg as tiles")
+    def test_atlas_layout(self):
+
+        atlasFolder = self.dataset.getFile(DSKeys.ATLAS_DIR)
+        layout = EPUParser.getAtlasLayout(atlasFolder)
+
+        ratio = 4096/907
+        expectedDimensions = int(3184 * ratio) + 4096
+        self.assertEqual((expectedDimensions, expectedDimensions), layout.getCanvasSize(), "Wrong layout canvas size")
+        self.assertEqual((0, 0), next(iter(layout))[1], "First tile not at the origin")
+
+        # Layout saved and loaded is the same
+        layoutFn = os.path.join(tempfile.mkdtemp(), "layout.npz")
+        layout.save(layoutFn)
+        loaded = AtlasLayout.load(layoutFn)
+        self.assertEqual(list(layout), list(loaded), "Loaded layout differs")
+
+        # Tiles cover the whole atlas
+        self.assertTrue(len(layout.getTilesAt(expectedDimensions - 1, expectedDimensions - 1)),
+                        "No tile covering the atlas corner")
+
+        # Reused by stitching
+        fullAtlasJpg = os.path.join(tempfile.mkdtemp(), "atlas.jpg")
+        EPUParser.createHRAtlas(atlasFolder, fullAtlasJpg, layout=loaded)
+        self.assertEqual(layout.getCanvasSize(), Image.open(fullAtlasJpg).size, "Atlas size differs from layout")
+
+    def test_createHRAtlas_parallel(self):
+
+        # Get temporary filenames
+        serialAtlas = tempfile.NamedTemporaryFile(suffix=".png", delete=False)
+        parallelAtlas = tempfile.NamedTemporaryFile(suffix=".png", delete=False)
+
+        EPUParser.createHRAtlas(self.dataset.getFile(DSKeys.ATLAS_DIR), serialAtlas.name)
+        EPUParser.createHRAtlas(self.dataset.getFile(DSKeys.ATLAS_DIR), parallelAtlas.name, threads=3)
+
+        # Assertions
+        serialImg = Image.open(serialAtlas)
+        parallelImg = Image.open(parallelAtlas)
+        self.assertEqual(serialImg.tobytes(), parallelImg.tobytes(), "Parallel HR atlas differs from the serial one")
+
+    def test_createHRAtlas_jpg_fallback(self):
+
+        # Get temporary filenames
+        inMemoryAtlas = tempfile.NamedTemporaryFile(suffix=".jpg", delete=False)
+        jpgAtlas = tempfile.NamedTemporaryFile(suffix=".jpg", delete=False)
+
+        EPUParser.createHRAtlas(self.dataset.getFile(DSKeys.ATLAS_DIR), inMemoryAtlas.name)
+        EPUParser.createHRAtlas(self.dataset.getFile(DSKeys.ATLAS_DIR), jpgAtlas.name, inMemory=False)
+
+        # Assertions
+        self.assertEqual(Image.open(inMemoryAtlas).size, Image.open(jpgAtlas).size,
+                         "HR atlas size differs between in memory and jpg tiles")
+
+    def test_save_atomically(self):
+
+        outputFolder = tempfile.mkdtemp()
+        outputFile = os.path.join(outputFolder, "atlas.jpg")
+        saveAtomically(Image.new("L", (16, 16)), outputFile)
+
+        self.assertEqual(["atlas.jpg"], os.listdir(outputFolder), "Temporary file left or output missing")
+
+        with self.assertRaises(ValueError):
+            saveAtomically(Image.new("L", (16, 16)), os.path.join(outputFolder, "atlas.unknown"))
+        self.assertEqual(["atlas.jpg"], os.listdir(outputFolder), "Temporary file left after a failed save")
+
+    def test_normalizeToUint8(self):
+
+        data = np.array([[-1., 0.], [1., 3.]])
+        self.assertEqual(EPUParser.normalizeToUint8(data).tolist(), [[0, 63], [127, 255]], "Wrong 8 bits normalization")
+        self.assertEqual(EPUParser.normalizeToUint8(np.ones((2, 2))).tolist(), [[0, 0], [0, 0]], "Wrong 8 bits normalization of a flat image")
+
+    def test_mrc_reader(self):
+
+        # Write a small 3x2 float mrc file
+        data = np.arange(6, dtype=np.float32).reshape((2, 3))
+        header = np.zeros(256, dtype=np.int32)
+        header[0:4] = (3, 2, 1, 2)
+        header = header.tobytes()
+        header = header[:208] + b"MAP DA\x00\x00" + header[216:]
+
+        mrcFn = tempfile.NamedTemporaryFile(suffix=".mrc", delete=False)
+        mrcFn.write(header + data.tobytes())
+        mrcFn.close()
+
+        mrc = MrcFile(mrcFn.name)
+        self.assertEqual((3, 2, 1, 1), mrc.getDimensions(), "Wrong mrc dimensions")
+        self.assertTrue(np.array_equal(data, mrc.getData()), "Wrong mrc data")
+        self.assertTrue(np.array_equal(data[::2, ::2], mrc.getData(step=2)), "Wrong downsampled mrc data")
+        self.assertTrue(mrc.isComplete(), "Mrc file with all its pixels not complete")
+
+        # Same file while being written
+        with open(mrcFn.name, "r+b") as f:
+            f.truncate(len(header) + 8)
+        self.assertFalse(MrcFile(mrcFn.name).isComplete(), "Truncated mrc file is complete")
+
+        # Real tile
+        mrc = MrcFile(self.dataset.getFile(DSKeys.TILEMRC1))
+        self.assertEqual((4096, 4096, 1, 1), mrc.getDimensions(), "Wrong tile dimensions")
+
+    def test_pyramid(self):
+
+        # Horizontal gradient of 600x300
+        data = np.tile(np.linspace(0, 255, 600).astype(np.uint8), (300, 1))
+        img = Image.fromarray(data, mode="L")
+
+        dziFn = os.path.join(tempfile.mkdtemp(), "atlas.dzi")
+        DeepZoomPyramid(dziFn).write(img, tileSize=256, tileFormat="png")
+        print("Pyramid at %s" % dziFn)
+
+        pyramid = DeepZoomPyramid.load(dziFn)
+        self.assertEqual((600, 300), pyramid.getSize(), "Wrong pyramid size")
+        self.assertEqual(10, pyramid.getMaxLevel(), "Wrong pyramid levels")
+        self.assertEqual((3, 2), pyramid.getLevelTiles(10), "Wrong number of tiles at full resolution")
+        self.assertEqual((1, 1), pyramid.getLevelSize(0), "Wrong size for the lowest level")
+        self.assertEqual((300, 150), pyramid.getLevelSize(9), "Wrong size for level 9")
+        self.assertEqual(9, pyramid.getLevelForSize(300), "Wrong level for a 300 pixels view")
+        self.assertTrue(os.path.exists(pyramid.getTileFn(0, 0, 0)), "Lowest level tile missing")
+
+        # Full resolution level must match the original image
+        self.assertEqual(img.tobytes(), pyramid.getRegion(10).tobytes(), "Full resolution level differs from the image")
+        self.assertEqual(img.crop((200, 100, 400, 280)).tobytes(),
+                         pyramid.getRegion(10, (200, 100, 400, 280)).tobytes(), "Wrong region")
+
+    def test_createHRAtlas_pyramid(self):
+
+        dziFn = os.path.join(tempfile.mkdtemp(), "atlas.dzi")
+        EPUParser.createHRAtlas(self.dataset.getFile(DSKeys.ATLAS_DIR), dziFn, pyramid=True)
+
+        ratio = 4096/907
+        expectedDimensions = int(3184 * ratio) + 4096
+
+        pyramid = DeepZoomPyramid.load(dziFn)
+        self.assertEqual((expectedDimensions, expectedDimensions), pyramid.getSize(), "Wrong HR atlas pyramid size")
+
+    def test_createHRAtlas_strips(self):
+
+        # Get temporary filenames
+        inMemoryAtlas = tempfile.NamedTemporaryFile(suffix=".png", delete=False)
+        stripsAtlas = tempfile.NamedTemporaryFile(suffix=".pgm", delete=False)
+
+        EPUParser.createHRAtlas(self.dataset.getFile(DSKeys.ATLAS_DIR), inMemoryAtlas.name)
+        EPUParser.createHRAtlas(self.dataset.getFile(DSKeys.ATLAS_DIR), stripsAtlas.name, stripHeight=1000)
+
+        # Assertions
+        self.assertEqual(Image.open(inMemoryAtlas).tobytes(), Image.open(stripsAtlas).tobytes(),
+                         "HR atlas composed in strips differs from the in memory one")
+
+    def test_file_watcher(self):
+
+        for watcher in [createFileWatcher(), PollingWatcher()]:
+            folder = tempfile.mkdtemp()
+            setFn = os.path.join(folder, "movies.sqlite")
+            metadataFolder = os.path.join(folder, "Metadata")
+            os.makedirs(metadataFolder)
+            open(setFn, "w").write("a")
+
+            watcher.watch(setFn)
+            watcher.watch(metadataFolder, recursive=True)
+            self.assertFalse(watcher.hasChanged(), "%s reports changes without any" % watcher.__class__.__name__)
+
+            time.sleep(0.01)
+            open(setFn, "a").write("b")
+            self.assertTrue(watcher.hasChanged(), "%s misses a file modification" % watcher.__class__.__name__)
+            self.assertFalse(watcher.hasChanged(), "%s reports the same change twice" % watcher.__class__.__name__)
+
+            gridSquareFolder = os.path.join(metadataFolder, "GridSquare_1")
+            os.makedirs(gridSquareFolder)
+            self.assertTrue(watcher.hasChanged(), "%s misses a new folder" % watcher.__class__.__name__)
+
+            time.sleep(0.01)
+            open(os.path.join(gridSquareFolder, "TargetLocation_1.dm"), "w").write("x")
+            self.assertTrue(watcher.hasChanged(), "%s misses a file in a new subfolder" % watcher.__class__.__name__)
+            watcher.close()
+
+    def test_gridSquare_index(self):
+
+        epuParser = EPUParser(self.dataset.getFile('importPath'))
+        movie = Movie("GRID_05_DATA_Images - Disc1_GridSquare_1818577_DATA_FoilHole_1821393_Data_1821842_1821843_20190904_0831_Fractions_global_shifts.mrc")
+        atlasLoc = epuParser.getAtlasLocation(movie)
+
+        index = GridSquareIndex(epuParser._getGridSquareMDFolder(atlasLoc))
+        self.assertEqual(epuParser.findCooordinatesFromHoleId(atlasLoc), index.getCoordinates(atlasLoc.hole.get()),
+                         "Indexed hole coordinates differ from the TargetLocation file ones")
+        self.assertTrue(len(index) >= 1, "GridSquare holes not indexed")
+        self.assertIsNone(index.getCoordinates("0"), "Coordinates found for a missing hole")
+
+    def test_session_index(self):
+
+        epuParser = EPUParser(self.dataset.getFile('importPath'))
+        index = epuParser.getSessionIndex()
+        gridFolder = os.path.join(self.dataset.getFile(DSKeys.ROOT), GRID_ + "05")
+
+        self.assertEqual(os.path.realpath(gridFolder), os.path.realpath(index.getGridFolder("05")), "Wrong grid folder")
+        self.assertEqual(os.path.join(index.getGridFolder("05"), "ATLAS", "Atlas_1.mrc"), index.getAtlas("05"),
+                         "Wrong atlas file")
+        self.assertIsNone(index.getGridFolder("99"), "Missing grid indexed")
+
+        # Lookups go through the index
+        gridSquareFolder = epuParser._getGridSquareMDFolderById("05", "1818577")
+        self.assertEqual(index.gridSquares[("05", "1818577")], gridSquareFolder, "GridSquare folder not from index")
+        self.assertTrue(os.path.isdir(gridSquareFolder), "Wrong GridSquare folder")
+
+        # Listing grids does not list the Metadata folders
+        gridsIndex = EPUSessionIndex(index.rootFolder)
+        gridsIndex.refresh(gridSquares=False)
+        self.assertIn("05", gridsIndex.grids, "Grid not indexed")
+        self.assertEqual({}, gridsIndex.gridSquares, "GridSquares listed when only grids are needed")
+
+    def test_dm_children_parsing(self):
+        """ Compares extraction of dm elements with a full xml tree parsing (timed in test_benchmarks)"""
+
+        def parseWholeTree(dmFile, parentTag):
+            # Reference: whole tree is built and then walked
+            root = ET.parse(dmFile).getroot()
+            for element in root:
+                if parentTag in element.tag:
+                    return [(child.tag, child.text) for child in element]
+
+        epuParser = EPUParser(self.dataset.getFile('importPath'))
+        movie = Movie("GRID_05_DATA_Images - Disc1_GridSquare_1818577_DATA_FoilHole_1821393_Data_1821842_1821843_20190904_0831_Fractions_global_shifts.mrc")
+        atlasLoc = epuParser.getAtlasLocation(movie)
+
+        for dmFile, parentTag in [(epuParser._getTargetLocationDmPath(atlasLoc), "StagePosition"),
+                                  (self.dataset.getFile(DSKeys.TILE1DM), "AtlasPixelPosition")]:
+
+            self.assertEqual(parseWholeTree(dmFile, parentTag), list(iterDmChildren(dmFile, parentTag)),
+                             "Extraction of %s differs from the xml tree" % parentTag)
+
+    def test_dm_children_nested_tag(self):
+
+        # Nested and similarly named elements before the root child wanted
+        dmFn = os.path.join(tempfile.mkdtemp(), "TargetLocation_1.dm")
+        with open(dmFn, "w") as f:
+            f.write('<TargetLocation xmlns="http://ns" xmlns:b="http://ns/b"><Extra><b:StagePosition>'
+                    '<b:X>9.0</b:X><b:Y>9.0</b:Y></b:StagePosition></Extra>'
+                    '<b:StagePositionOffset><b:X>8.0</b:X><b:Y>8.0</b:Y></b:StagePositionOffset><Empty/>'
+                    '<b:StagePosition><b:X>1.5</b:X><b:Y>2.5</b:Y></b:StagePosition></TargetLocation>')
+
+        self.assertEqual((1.5, 2.5), EPUParser.getTargetLocationCoordinates(dmFn),
+                         "Coordinates not taken from the StagePosition child of the root")
+
+    def test_holes_cache(self):
+
+        cacheFn = os.path.join(tempfile.mkdtemp(), "holes.sqlite")
+        holesCache = HoleLocationsCache(cacheFn)
+        holesCache.putMany("05", "11", [("1", 1.0, 2.0, 100), ("2", 3.0, 4.0, 100)])
+
+        self.assertEqual((1.0, 2.0), holesCache.get("05", "11", "1", 100), "Cached hole not found")
+        self.assertIsNone(holesCache.get("05", "11", "1", 200), "Hole from a modified file returned")
+        self.assertEqual({"1": (1.0, 2.0, 100), "2": (3.0, 4.0, 100)}, holesCache.getGridSquare("05", "11"),
+                         "Wrong GridSquare holes")
+
+        # Another cache filled from the first one
+        otherCache = HoleLocationsCache(os.path.join(tempfile.mkdtemp(), "holes.sqlite"))
+        otherCache.importFrom(cacheFn)
+        self.assertEqual(2, len(otherCache), "Holes cache not imported")
+
+        # Index filling the cache gives the same coordinates as reading the files
+        epuParser = EPUParser(self.dataset.getFile('importPath'))
+        movie = Movie("GRID_05_DATA_Images - Disc1_GridSquare_1818577_DATA_FoilHole_1821393_Data_1821842_1821843_20190904_0831_Fractions_global_shifts.mrc")
+        atlasLoc = epuParser.getAtlasLocation(movie)
+        gridSquareFolder = epuParser._getGridSquareMDFolder(atlasLoc)
+
+        cachedIndex = GridSquareIndex(gridSquareFolder, "05", "1818577", holesCache)
+        self.assertEqual(epuParser.findCooordinatesFromHoleId(atlasLoc), cachedIndex.getCoordinates(atlasLoc.hole.get()),
+                         "Wrong coordinates indexed with a cache")
+        self.assertEqual(len(cachedIndex), len(holesCache.getGridSquare("05", "1818577")), "Indexed holes not cached")
+
+        # A new index reads them from the cache
+        newIndex = GridSquareIndex(gridSquareFolder, "05", "1818577", HoleLocationsCache(cacheFn))
+        self.assertEqual(cachedIndex.getCoordinates(atlasLoc.hole.get()), newIndex.getCoordinates(atlasLoc.hole.get()),
+                         "Wrong coordinates read from the cache")
+
+    def test_hotpath_stats(self):
+
+        stats = HotPathStats()
+        stats.count("movies", 2)
+        stats.count("movies")
+        for milliseconds in range(1, 101):
+            stats.addTime("step", milliseconds / 1000.0)
+        with stats.timer("block"):
+            pass
+
+        statsFn = os.path.join(tempfile.mkdtemp(), "stats.json")
+        stats.write(statsFn)
+        written = HotPathStats.read(statsFn)
+
+        self.assertEqual(3, written["counters"]["movies"], "Wrong counter")
+        self.assertEqual(100, written["latencies"]["step"]["count"], "Wrong latency count")
+        self.assertAlmostEqual(5.05, written["latencies"]["step"]["total"], places=6, msg="Wrong total time")
+        self.assertTrue(0.05 <= written["latencies"]["step"]["p50"] <= 0.1, "Wrong median estimate")
+        self.assertEqual(1, written["latencies"]["block"]["count"], "Timer not recorded")
+        self.assertIsNone(HotPathStats.read(statsFn + ".missing"), "Statistics read from a missing file")
+
+    def test_render_cache(self):
+
+        outputFolder = tempfile.mkdtemp()
+        renderCache = RenderCache(os.path.join(outputFolder, "cache"))
+        epuParser = EPUParser(self.dataset.getFile('importPath'))
+        mrcFn = self.dataset.getFile(DSKeys.TILEMRC1)
+
+        firstJpg = os.path.join(outputFolder, "first.jpg")
+        self.assertFalse(epuParser.createLRAtlas(mrcFn, firstJpg, maxSize=512, renderCache=renderCache),
+                         "Atlas taken from an empty cache")
+
+        # Same source and parameters: served from the cache with another name
+        secondJpg = os.path.join(outputFolder, "second.jpg")
+        self.assertTrue(epuParser.createLRAtlas(mrcFn, secondJpg, maxSize=512, renderCache=renderCache),
+                        "Atlas not taken from the cache")
+        self.assertEqual(open(firstJpg, "rb").read(), open(secondJpg, "rb").read(), "Cached atlas differs")
+
+        # Other parameters are another entry
+        self.assertFalse(epuParser.createLRAtlas(mrcFn, secondJpg, maxSize=256, renderCache=renderCache),
+                         "Atlas with other parameters taken from the cache")
+        self.assertEqual((256, 256), Image.open(secondJpg).size, "Atlas rendered with wrong parameters")
+        self.assertEqual((512, 512), Image.open(firstJpg).size, "Cached atlas changed by a later render")
+
+    def test_render_cache_same_name(self):
+
+        # Atlas of two grids with the same name, size and modification time, as extracted from a tarball
+        root = tempfile.mkdtemp()
+        renderCache = RenderCache(os.path.join(root, "cache"))
+        atlasFns = []
+        for grid, data in [("01", np.zeros((64, 64))), ("02", np.tile(np.arange(64.), (64, 1)))]:
+            atlasFolder = os.path.join(root, GRID_ + grid, "ATLAS")
+            os.makedirs(atlasFolder)
+            atlasFns.append(os.path.join(atlasFolder, "Atlas_1.mrc"))
+            writeMrc(atlasFns[-1], data)
+            os.utime(atlasFns[-1], ns=(0, 0))
+
+        epuParser = EPUParser(os.path.join(root, GRID_ + "??", "Data"))
+        jpgFns = [os.path.join(root, "GRID_01_atlas.jpg"), os.path.join(root, "GRID_02_atlas.jpg")]
+        self.assertFalse(epuParser.createLRAtlas(atlasFns[0], jpgFns[0], renderCache=renderCache),
+                         "Atlas taken from an empty cache")
+        self.assertFalse(epuParser.createLRAtlas(atlasFns[1], jpgFns[1], renderCache=renderCache),
+                         "Atlas of another grid taken from the cache")
+        self.assertNotEqual(open(jpgFns[0], "rb").read(), open(jpgFns[1], "rb").read(), "Grid atlases are the same")
+
+    def test_repeated_hole_ids(self):
+
+        # Same hole id in two GridSquares of two grids
+        root = tempfile.mkdtemp()
+        for grid, gridSquare, x in (("01", "10", 1.5), ("02", "20", 2.5)):
+            gridSquareFolder = os.path.join(root, GRID_ + grid, "DATA", "Metadata", GRIDSQUARE_MD + gridSquare)
+            os.makedirs(gridSquareFolder)
+            with open(os.path.join(gridSquareFolder, TARGET_LOCATION_FILE_PATTERN % "7"), "w") as f:
+                f.write(TARGET_LOCATION_DM % (x, x, ""))
+
+        epuParser = EPUParser(os.path.join(root, GRID_ + "??", "Data"))
+        self.assertEqual((1.5, 1.5), epuParser._getCoordinatesById("01", "10", "7"), "Wrong hole coordinates")
+        self.assertEqual((2.5, 2.5), epuParser._getCoordinatesById("02", "20", "7"),
+                         "Coordinates of a hole with the same id in another GridSquare")
+
+    def test_malformed_target_location(self):
+
+        root = tempfile.mkdtemp()
+        gridSquareFolder = os.path.join(root, GRID_ + "01", "DATA", "Metadata", GRIDSQUARE_MD + "10")
+        os.makedirs(gridSquareFolder)
+        with open(os.path.join(gridSquareFolder, TARGET_LOCATION_FILE_PATTERN % "7"), "w") as f:
+            f.write(TARGET_LOCATION_DM % (1.5, 2.5, ""))
+        # Empty X
+        with open(os.path.join(gridSquareFolder, TARGET_LOCATION_FILE_PATTERN % "8"), "w") as f:
+            f.write((TARGET_LOCATION_DM % (1.5, 2.5, "")).replace("<a:X>1.5</a:X>", "<a:X></a:X>"))
+
+        epuParser = EPUParser(os.path.join(root, GRID_ + "??", "Data"))
+        locations = epuParser.getAtlasLocations(["GRID_01_DATA_GridSquare_10_DATA_FoilHole_8_Data.mrc",
+                                                 "GRID_01_DATA_GridSquare_10_DATA_FoilHole_7_Data.mrc"])
+
+        self.assertEqual([False, True], locations['found'].tolist(), "Malformed file should only fail its movie")
+        self.assertEqual((1.5, 2.5), (locations[1]['x'], locations[1]['y']), "Wrong location after a malformed file")
+
+        with self.assertRaises(ValueError):
+            epuParser.getAtlasLocation(Movie("GRID_01_DATA_GridSquare_10_DATA_FoilHole_8_Data.mrc"))
+
+    @staticmethod
+    def _createMovies(count):
+        """ Returns a SetOfMovies with count movies, with ids 1 to count"""
+        movies = SetOfMovies(filename=os.path.join(tempfile.mkdtemp(), "movies.sqlite"))
+        for index in range(1, count + 1):
+            movies.append(Movie(location="movie_%d.mrc" % index))
+        movies.write()
+        return movies
+
+    def _newBatchingProtocol(self, **kwargs):
+        """ Returns an AtlasEPUImporter recording the batches instead of inserting steps"""
+        atlasProt = self.newProtocol(AtlasEPUImporter, **kwargs)
+        atlasProt.batches = []
+        atlasProt._insertMoviesStep = lambda batch: atlasProt.batches.append(batch) or len(atlasProt.batches)
+        return atlasProt
+
+    def test_select_columns(self):
+
+        movies = self._createMovies(5)
+
+        self.assertEqual([(index, "movie_%d.mrc" % index) for index in range(1, 6)],
+                         [tuple(row) for row in selectColumns(movies, [ID, "_filename"])], "Wrong id, filename rows")
+        self.assertEqual([("movie_4.mrc", 4), ("movie_5.mrc", 5)],
+                         [tuple(row) for row in selectColumns(movies, ["_filename", ID], minId=3)],
+                         "Columns not in labels order or minId not applied")
+        self.assertEqual([], selectColumns(movies, [ID], minId=5), "Rows not newer than minId read")
+
+    def test_movies_batching(self):
+
+        newMovies = [(index, "movie_%d.mrc" % index) for index in range(1, 8)]
+
+        # Only complete batches, the rest waits until the stream is closed
+        atlasProt = self._newBatchingProtocol(streamingBatchSize=3, streamingBatchTime=0)
+        self.assertEqual([1, 2], atlasProt._insertNewMoviesSteps(newMovies), "Wrong steps inserted")
+        self.assertEqual([newMovies[:3], newMovies[3:6]], atlasProt.batches, "Wrong batches")
+        self.assertEqual(6, atlasProt.lastIdSeen.get(), "Last id with a step not updated")
+        self.assertEqual([], atlasProt._insertNewMoviesSteps(newMovies), "Movies with steps queued again")
+        atlasProt._insertNewMoviesSteps([], flush=True)
+        self.assertEqual(newMovies[6:], atlasProt.batches[-1], "Incomplete batch not flushed")
+        self.assertEqual(7, atlasProt.lastIdSeen.get(), "Last id with a step not updated on flush")
+
+        # Batch size 0 takes all available movies
+        atlasProt = self._newBatchingProtocol(streamingBatchSize=0, streamingBatchTime=0)
+        atlasProt._insertNewMoviesSteps(newMovies)
+        self.assertEqual([newMovies], atlasProt.batches, "Not all movies in a single batch")
+
+        # Incomplete batches waiting longer than the batch time are flushed
+        atlasProt = self._newBatchingProtocol(streamingBatchSize=10, streamingBatchTime=60)
+        atlasProt._insertNewMoviesSteps(newMovies)
+        self.assertEqual([], atlasProt.batches, "Incomplete batch inserted before the batch time")
+        atlasProt._pendingSince -= datetime.timedelta(seconds=61)
+        atlasProt._insertNewMoviesSteps([])
+        self.assertEqual([newMovies], atlasProt.batches, "Incomplete batch not inserted after the batch time")
+
+    def test_new_movies_resume(self):
+
+        movies = self._createMovies(5)
+        atlasProt = self._newBatchingProtocol()
+        atlasProt._getInputMovies = lambda: movies
+
+        # As after a restart: movies up to the persisted last id already have a step
+        atlasProt.lastIdSeen.set(3)
+        self.assertEqual([(4, "movie_4.mrc"), (5, "movie_5.mrc")], atlasProt._getNewMovies(),
+                         "Not resumed from the last id seen")
+        self.assertEqual([], atlasProt._getNewMovies(), "Movies read twice")
+
+        movies.append(Movie(location="movie_6.mrc"))
+        movies.write()
+        self.assertEqual([(6, "movie_6.mrc")], atlasProt._getNewMovies(), "New movie not read")
+
+    def test_new_movies_restart(self):
+
+        movies = self._createMovies(5)
+        atlasProt = self._newBatchingProtocol()
+        atlasProt._getInputMovies = lambda: movies
+
+        # Persisted last id of a previous run, but no output: all the movies are read again
+        atlasProt.lastIdSeen.set(3)
+        atlasProt._insertAllSteps()
+        self.assertEqual(0, atlasProt.lastIdSeen.get(), "Last id seen not reset when starting from scratch")
+        self.assertEqual(list(range(1, 6)), [movieId for movieId, movieFn in atlasProt._getNewMovies()],
+                         "Movies of the previous run not read again")
+
+    def test_lru_cache(self):
+
+        cache = LRUCache(2)
+        cache.put("a", 1)
+        cache.put("b", 2)
+        self.assertEqual(1, cache.get("a"), "Cached value not returned")
+
+        # b is the least recently used
+        cache.put("c", 3)
+        self.assertIsNone(cache.get("b"), "Least recently used item not evicted")
+        self.assertEqual(2, len(cache), "Cache over capacity")
+        self.assertTrue("a" in cache and "c" in cache, "Wrong item evicted")
+
+        stats = cache.getStats()
+        self.assertEqual((1, 1, 1), (stats["hits"], stats["misses"], stats["evictions"]), "Wrong cache counters")
+
+        # Sized items: evicted until the sum of sizes fits, growing items are put again
+        cache = LRUCache(5, sizeOf=len)
+        cache.put("a", [1, 2])
+        cache.put("b", [1, 2])
+        growing = [1]
+        cache.put("c", growing)
+        growing.extend([2, 3])
+        cache.put("c", growing)
+        self.assertEqual((["b", "c"], 5), (sorted(cache._items), cache.getSize()), "Wrong items evicted by size")
+
+    def test_holes_capacity(self):
+
+        session = SyntheticEPUSession(tempfile.mkdtemp(), gridSquares=2, holes=100, dmPadding=0).write()
+        movieFns = session.getMovieFileNames()
+        epuParser = EPUParser(session.getImportPath(), holesCapacity=150)
+        locations = epuParser.getAtlasLocations(movieFns)
+
+        self.assertTrue(locations['found'].all(), "Holes not located")
+        self.assertEqual([session.getStagePosition(*location) for location in locations[['grid', 'gridSquare', 'hole']]],
+                         list(zip(locations['x'], locations['y'])), "Wrong holes locations")
+
+        # Holes of the first GridSquare are discarded to keep the second ones
+        stats = epuParser.getCacheStats()["holes"]
+        self.assertEqual((150, 100, 1, 1), (stats["capacity"], stats["size"], stats["items"], stats["evictions"]),
+                         "Holes in memory not bounded by the capacity")
@@ -0,0 +1,240 @@
+# **************************************************************************
+# *
+# * Authors:   Pablo Conesa       (pconesa@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Benchmarks of the plugin hot paths over synthetic EPU sessions (see synthetic.py), no data download needed.
+Wall times depend on the machine, so they are skipped unless ATLAS_BENCHMARKS is set:
+
+    ATLAS_BENCHMARKS=1 scipion3 tests atlas.tests.test_benchmarks
+
+Measures are compared with benchmark_baselines.json and a benchmark fails when it is ATLAS_BENCHMARK_TOLERANCE
+times (3 by default) worse than its baseline. Run with ATLAS_BENCHMARK_UPDATE=1 to store the measures as baselines.
+Stored baselines do not include the viewerData_* measures, since they need a Scipion project: measures
+without a baseline are only printed.
+"""
+import json
+import multiprocessing
+import os
+import resource
+import shutil
+import tempfile
+import time
+import unittest
+import xml.etree.ElementTree as ET
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from PIL import Image
+from pwem.objects import Movie
+from pyworkflow.tests import BaseTest, setupTestProject
+
+from ..collage import Collage
+from ..objects import AtlasLocation, SetOfAtlasLocations
+from ..parsers import EPUParser, TARGET_LOCATION_FILE_PATTERN, iterDmChildren
+from ..viewers import AtlasImporterViewer
+from .synthetic import SyntheticEPUSession
+
+BENCHMARKS_VAR = "ATLAS_BENCHMARKS"
+BASELINES_FILE = os.path.join(os.path.dirname(__file__), "benchmark_baselines.json")
+TOLERANCE_VAR = "ATLAS_BENCHMARK_TOLERANCE"
+UPDATE_VAR = "ATLAS_BENCHMARK_UPDATE"
+
+
+def timeIt(function, repeat=1):
+    """ Returns the best wall time in seconds of calling function repeat times"""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+
+    return min(times)
+
+
+def getPeakRSS():
+    """ Returns the peak resident memory of this process in MB"""
+    # Linux reports KB
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def getRSS():
+    """ Returns the current resident memory of this process in MB"""
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * resource.getpagesize() / 1024 ** 2
+
+
+def createHRAtlasChild(atlasFolder, outputFile, **kwargs):
+    """ Creates the HR atlas in a fresh process, returning its wall time and the memory peak it adds in MB"""
+    startRSS = getRSS()
+    seconds = timeIt(lambda: EPUParser.createHRAtlas(atlasFolder, outputFile, **kwargs))
+    return seconds, getPeakRSS() - startRSS
+
+
+@unittest.skipUnless(os.environ.get(BENCHMARKS_VAR), "Set %s=1 to run the benchmarks" % BENCHMARKS_VAR)
+class TestAtlasBenchmarks(BaseTest):
+    """ Times the plugin hot paths at several sizes """
+
+    @classmethod
+    def setUpClass(cls):
+        setupTestProject(cls)
+        cls.tmpFolder = tempfile.mkdtemp()
+        cls.measures = {}
+
+        cls.baselines = {}
+        if os.path.exists(BASELINES_FILE):
+            with open(BASELINES_FILE) as f:
+                cls.baselines = json.load(f)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmpFolder, ignore_errors=True)
+
+        print("\nBenchmark measure (baseline)")
+        for name, value in sorted(cls.measures.items()):
+            print("%s: %.4f (%s)" % (name, value, cls.baselines.get(name, "-")))
+
+        if os.environ.get(UPDATE_VAR):
+            cls.baselines.update(cls.measures)
+            with open(BASELINES_FILE, "w") as f:
+                json.dump(cls.baselines, f, indent=2, sort_keys=True)
+            print("Baselines updated at %s" % BASELINES_FILE)
+
+    def checkMeasure(self, name, value):
+        """ Records a measure (lower is better) and fails if it is much worse than its baseline"""
+        self.measures[name] = value
+        baseline = self.baselines.get(name)
+
+        if baseline is None or os.environ.get(UPDATE_VAR):
+            return
+
+        tolerance = float(os.environ.get(TOLERANCE_VAR, 3))
+        self.assertLessEqual(value, baseline * tolerance,
+                             "%s regressed: %.4f vs %.4f baseline" % (name, value, baseline))
+
+    def checkLocations(self, session, movieFns, locations):
+        """ Checks the x, y located for each movie are the ones written for its hole"""
+        for movieFn, location in zip(movieFns, locations):
+            self.assertTrue(location['found'], "%s not located" % movieFn)
+            self.assertEqual(session.getStagePosition(location['grid'], location['gridSquare'], location['hole']),
+                             (location['x'], location['y']), "Wrong location for %s" % movieFn)
+
+    def getSession(self, name, **kwargs):
+        """ Writes a synthetic EPU session under the benchmarks temporary folder"""
+        return SyntheticEPUSession(os.path.join(self.tmpFolder, name), **kwargs).write()
+
+    def test_atlas_location_throughput(self):
+
+        for holes in (100, 1000):
+            session = self.getSession("holes%s" % holes, gridSquares=4, holes=holes)
+            movieFns = session.getMovieFileNames()
+            movies = [Movie(location=movieFn) for movieFn in movieFns]
+
+            # A fresh parser each time, so the metadata files are parsed again
+            atlasLocs = []
+
+            def getAtlasLocation():
+                parser = EPUParser(session.getImportPath())
+                atlasLocs[:] = [parser.getAtlasLocation(movie) for movie in movies]
+
+            seconds = timeIt(getAtlasLocation)
+            print("getAtlasLocation: %d movies/s" % (len(movies) / seconds))
+            self.checkMeasure("getAtlasLocation_%s" % len(movies), seconds)
+            self.checkLocations(session, movieFns, [{'found': True, 'grid': atlasLoc.grid.get(),
+                                                     'gridSquare': atlasLoc.gridSquare.get(),
+                                                     'hole': atlasLoc.hole.get(), 'x': atlasLoc.x.get(),
+                                                     'y': atlasLoc.y.get()} for atlasLoc in atlasLocs])
+
+            locations = []
+            seconds = timeIt(lambda: locations.append(EPUParser(session.getImportPath()).getAtlasLocations(movieFns)))
+            print("getAtlasLocations: %d movies/s" % (len(movies) / seconds))
+            self.checkMeasure("getAtlasLocations_%s" % len(movies), seconds)
+            self.checkLocations(session, movieFns, locations[-1])
+
+    def test_dm_children_parsing(self):
+
+        session = self.getSession("dm", gridSquares=1, holes=1)
+        grid, gridSquare = session.grids[0], session.gridSquares[0]
+        targetLocationFn = os.path.join(EPUParser._getMetadataFolderFn(session.getGridFolder(grid)),
+                                        "GridSquare_" + gridSquare,
+                                        TARGET_LOCATION_FILE_PATTERN % session.getHoles(grid, gridSquare)[0])
+        tileDmFn = os.path.splitext(EPUParser.getTileMrcFiles(session.getAtlasFolder(grid))[0])[0] + ".dm"
+
+        for name, dmFile, parentTag in [("TargetLocation", targetLocationFn, "StagePosition"),
+                                        ("Tile", tileDmFn, "AtlasPixelPosition")]:
+            repeat = 200
+            # Reference: whole tree is built and then walked
+            treeTime = timeIt(lambda: [[(child.tag, child.text) for child in element]
+                                       for element in ET.parse(dmFile).getroot() if parentTag in element.tag],
+                              repeat=repeat)
+            elementTime = timeIt(lambda: list(iterDmChildren(dmFile, parentTag)), repeat=repeat)
+            print("%s: xml tree %.1f us, element only %.1f us per file (x%.1f)"
+                  % (name, treeTime * 1e6, elementTime * 1e6, treeTime / elementTime))
+
+            self.checkMeasure("dmChildren_%s_seconds" % name, elementTime)
+            self.checkMeasure("dmTree_%s_seconds" % name, treeTime)
+
+    def test_createHRAtlas(self):
+
+        for tilesPerSide in (2, 4):
+            session = self.getSession("tiles%s" % tilesPerSide, tilesPerSide=tilesPerSide, tileSize=2048,
+                                      gridSquares=1, holes=1)
+            outputFile = os.path.join(self.tmpFolder, "hr%s.jpg" % tilesPerSide)
+
+            # Fresh process, so its peak memory is only the atlas one
+            with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as executor:
+                seconds, peakRSS = executor.submit(createHRAtlasChild, session.getAtlasFolder(session.grids[0]),
+                                                   outputFile).result()
+
+            tiles = tilesPerSide ** 2
+            self.checkMeasure("createHRAtlas_%s_seconds" % tiles, seconds)
+            self.checkMeasure("createHRAtlas_%s_peakMB" % tiles, peakRSS)
+
+    def test_collage_scaling(self):
+
+        for tilesPerSide in (8, 16, 32):
+            tile = Image.fromarray(np.random.randint(0, 255, (256, 256), dtype=np.uint8), mode="L")
+            placements = [(tile, (column * 240, row * 240))
+                          for row in range(tilesPerSide) for column in range(tilesPerSide)]
+
+            seconds = timeIt(lambda: Collage().addImages(placements), repeat=3)
+            self.checkMeasure("collage_%s" % len(placements), seconds)
+
+    def test_viewer_data_loading(self):
+
+        viewer = AtlasImporterViewer(project=self.proj)
+
+        for locations in (1000, 10000):
+            atlasSet = SetOfAtlasLocations(filename=os.path.join(self.tmpFolder, "atlas%s.sqlite" % locations))
+            for index in range(locations):
+                atlasLoc = AtlasLocation()
+                atlasLoc.grid.set("%02d" % (index % 4))
+                atlasLoc.x.set(index * 1e-8)
+                atlasLoc.y.set(index * 2e-8)
+                atlasSet.append(atlasLoc)
+            atlasSet.write()
+
+            seconds = timeIt(lambda: viewer._getData(atlasSet), repeat=3)
+            self.checkMeasure("viewerData_%s" % locations, seconds)
+            atlasSet.close()
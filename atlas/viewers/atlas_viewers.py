@@ -23,15 +23,25 @@
 # *  e-mail address 'scipion@cnb.csic.es'
 # *
 # **************************************************************************
+import os
+
 from PIL import Image
 import numpy as np
+from atlas import Plugin, ATLAS_DENSITY_THRESHOLD
 from atlas.parsers import GRID_
+from atlas.pyramid import DeepZoomPyramid
 
 from pyworkflow.gui.plotter import Plotter
 from pyworkflow.viewer import Viewer, DESKTOP_TKINTER
-from atlas.objects import SetOfAtlasLocations
+from atlas.objects import SetOfAtlasLocations, selectColumns
 from ..protocols import AtlasEPUImporter
 
+# Contrast stretch of the atlas background, as a lookup table for PIL Image.point
+CONTRAST_LUT = [min(int(value * 1.5), 255) for value in range(256)]
+
+# Bins of the largest side of the density plot
+DENSITY_BINS = 256
+
 
 class AtlasImporterViewer(Viewer):
     _environments = [DESKTOP_TKINTER]
@@ -62,29 +72,56 @@ class AtlasImporterViewer(Viewer):
 
         self.loadAtlasImg(plt, grid)
 
-        colors = ["cyan"] * len(x)
-        area = np.pi * 3
-        plotter.scatterP(x, y, s=area, c=colors, edgecolors='none', alpha=1)
+        if len(x) > self.getDensityThreshold():
+            # Too many points to draw them one by one: show how many acquisitions fall in each area
+            density, extent = self.getDensity(x, y)
+            image = plt.imshow(density, cmap='hot', extent=extent, origin='lower', alpha=0.6, interpolation='nearest')
+            plotter.getFigure().colorbar(image, ax=plt, label="Acquisitions")
+        else:
+            colors = ["cyan"] * len(x)
+            area = np.pi * 3
+            plotter.scatterP(x, y, s=area, c=colors, edgecolors='none', alpha=1)
 
         return plotter
 
+    @staticmethod
+    def getDensityThreshold():
+        """ Returns the number of locations above which the density is shown instead of the points"""
+        return int(Plugin.getVar(ATLAS_DENSITY_THRESHOLD, 50000))
+
+    @staticmethod
+    def getDensity(x, y, bins=DENSITY_BINS):
+        """ Bins the locations in a 2D histogram
+
+        :param x: array with the x of each location
+        :param y: array with the y of each location
+        :param bins: number of bins of the largest side, bins are square
+        :return masked array (rows are y) with the locations per bin, empty bins masked, and its extent"""
+        xMin, xMax = np.min(x), np.max(x)
+        yMin, yMax = np.min(y), np.max(y)
+        binSize = max(xMax - xMin, yMax - yMin, np.finfo(np.float32).eps) / bins
+
+        xEdges = np.arange(int(np.ceil((xMax - xMin) / binSize)) + 2) * binSize + xMin
+        yEdges = np.arange(int(np.ceil((yMax - yMin) / binSize)) + 2) * binSize + yMin
+        counts, xEdges, yEdges = np.histogram2d(x, y, bins=(xEdges, yEdges))
+
+        return np.ma.masked_equal(counts.T, 0), [xEdges[0], xEdges[-1], yEdges[0], yEdges[-1]]
+
     def loadAtlasImg(self, plt, grid):
 
         # Load the atlas image
         # This is hard coded. Need to find out how to relate atlas image to locations.
-        img = Image.open(self.getAtlasImagePath(grid))
-        img = img.convert('L')
-        img = img.point(lambda p: p * 1.5)
-        extWidth = self.getAtlasPlotWidth(img)
         #extX = -0.0015
         #extY = -0.00055
         extX = self.convertUnits(-0.0010849264)
         extY = self.convertUnits(-0.00108488)
         #extY = extX = -extWidth/2
 
-        extent = [extX, extX + extWidth,
-                  extY, extY + extWidth]
-        plt.imshow(img, cmap='gray', extent=extent)
+        background = AtlasBackground(plt, self.getAtlasImagePath(grid), self.getAtlasPyramidPath(grid))
+        extWidth = self.getAtlasPlotWidth(background.getWidth())
+        background.show([extX, extX + extWidth,
+                         extY, extY + extWidth])
+        return background
 
     @staticmethod
     def convertUnits(value):
@@ -101,27 +138,162 @@ class AtlasImporterViewer(Viewer):
         """ Returns the Jpg atlas file converted by the protocol from the mrc atlas"""
         return self.protocol.getAtlasJpgByGrid(GRID_ + grid)
 
-    def getAtlasPlotWidth(self, atlasImage):
-        return self.getAtlasPixelSize() * atlasImage.size[0]
+    def getAtlasPyramidPath(self, grid):
+        """ Returns the multi resolution atlas (dzi) produced by the protocol, if any"""
+        if self.protocol is None:
+            return None
+        return self.protocol.getAtlasPyramidByGrid(GRID_ + grid)
+
+    def getAtlasPlotWidth(self, atlasWidth):
+        """ Returns the plot width of the atlas image from its full resolution width in pixels"""
+        return self.getAtlasPixelSize() * atlasWidth
 
     def _getData(self, atlasSet):
 
         # We need to group data by grids
         # We will have a {"05": (x[],y[])
-        grids = {}
+        # Read the columns straight from the set sqlite, without building any AtlasLocation
+        rows = selectColumns(atlasSet, ["grid", "x", "y"])
 
-        # Iterate the movies
-        for atlasLoc in atlasSet.iterItems():
-            grid = atlasLoc.grid.get()
+        if not rows:
+            return {}
 
-            if grid not in grids:
-                grids[grid] = ([], [])
+        grids, x, y = zip(*rows)
 
-            x = grids[grid][0]
-            y = grids[grid][1]
+        # Create data
+        return self.groupByGrid(np.array(grids),
+                                self.convertUnits(np.array(x, dtype=np.float64)),
+                                self.convertUnits(np.array(y, dtype=np.float64)))
 
-            x.append(self.convertUnits(atlasLoc.x.get()))
-            y.append(self.convertUnits(atlasLoc.y.get()))
+    @staticmethod
+    def groupByGrid(grids, x, y):
+        """ Groups x and y arrays by the grid they belong to
 
-        # Create data
-        return grids
+        :param grids: array with the grid of each location
+        :param x: array with the x of each location
+        :param y: array with the y of each location
+        :return dictionary like {"05": (x[], y[])} keeping the locations order within each grid"""
+
+        uniqueGrids, gridIndexes = np.unique(grids, return_inverse=True)
+
+        # Stable sort to keep the original order of each grid locations
+        order = np.argsort(gridIndexes, kind="stable")
+        bounds = np.cumsum(np.bincount(gridIndexes, minlength=len(uniqueGrids)))[:-1]
+
+        xByGrid = np.split(x[order], bounds)
+        yByGrid = np.split(y[order], bounds)
+
+        return {str(grid): (xByGrid[index], yByGrid[index]) for index, grid in enumerate(uniqueGrids)}
+
+
+class AtlasBackground:
+    """ Atlas image shown behind the locations, loaded at the resolution the plot needs.
+
+    With a DeepZoom pyramid (.dzi), the level matching the plot size is shown and, when zooming in,
+    only the visible region of a more detailed level is read. Without it, the jpg is decoded downsampled."""
+
+    def __init__(self, axes, imageFn, pyramidFn=None):
+        self.axes = axes
+        self.imageFn = imageFn
+        self.pyramid = None
+        self.level = None
+        self.extent = None
+        self.regionImage = None
+        self._regionKey = None
+
+        if pyramidFn and os.path.exists(pyramidFn):
+            self.pyramid = DeepZoomPyramid.load(pyramidFn)
+
+    def getWidth(self):
+        """ Returns the full resolution width of the atlas in pixels"""
+        if self.pyramid is not None:
+            return self.pyramid.getSize()[0]
+
+        # Only the header is read here
+        return Image.open(self.imageFn).size[0]
+
+    def getPlotPixels(self):
+        """ Returns the size in screen pixels of the largest side of the plot"""
+        bbox = self.axes.get_window_extent()
+        return max(int(bbox.width), int(bbox.height), 1)
+
+    def show(self, extent):
+        """ Shows the atlas image, at the plot resolution, filling extent ([left, right, bottom, top] plot units)"""
+        self.extent = extent
+        size = self.getPlotPixels()
+
+        if self.pyramid is not None:
+            self.level = self.pyramid.getLevelForSize(size)
+            img = self.pyramid.getRegion(self.level)
+            # Load detail only for the zoomed region, once limits are final. Bound methods are only weakly
+            # referenced by matplotlib: a function keeps this background alive as long as the figure
+            self.axes.figure.canvas.mpl_connect('draw_event', lambda event: self._onDraw(event))
+        else:
+            img = Image.open(self.imageFn)
+            # Jpeg is decoded already downsampled (by 2, 4 or 8) to the closest size above the requested one
+            img.draft('L', (size, size))
+            img.thumbnail((size, size))
+
+        self.axes.imshow(self.enhance(img), cmap='gray', extent=extent)
+
+    @staticmethod
+    def enhance(img):
+        """ Returns the image as grayscale with the contrast stretched"""
+        return img.convert('L').point(CONTRAST_LUT)
+
+    def getRegionBox(self, level, xlim, ylim):
+        """ Returns the pixel box (left, upper, right, lower) of a pyramid level covering the plot limits and its extent
+
+        :parameter level: pyramid level
+        :parameter xlim: (min, max) x plot limits
+        :parameter ylim: (min, max) y plot limits
+        :return box tuple and extent list, or None, None if limits are out of the atlas"""
+        left, right, bottom, top = self.extent
+        width, height = self.pyramid.getLevelSize(level)
+        xPixel = (right - left) / width
+        yPixel = (top - bottom) / height
+
+        # Image rows start at the top of the extent
+        box = (max(int(np.floor((min(xlim) - left) / xPixel)), 0),
+               max(int(np.floor((top - max(ylim)) / yPixel)), 0),
+               min(int(np.ceil((max(xlim) - left) / xPixel)), width),
+               min(int(np.ceil((top - min(ylim)) / yPixel)), height))
+
+        if box[0] >= box[2] or box[1] >= box[3]:
+            return None, None
+
+        extent = [left + box[0] * xPixel, left + box[2] * xPixel,
+                  top - box[3] * yPixel, top - box[1] * yPixel]
+
+        return box, extent
+
+    def _onDraw(self, event):
+        """ Shows the visible region of the atlas at the level matching the zoom, when more detailed than the background"""
+        xlim = self.axes.get_xlim()
+        ylim = self.axes.get_ylim()
+        left, right, bottom, top = self.extent
+
+        # Level whose full width would fill the plot at this zoom
+        zoom = (right - left) / max(abs(xlim[1] - xlim[0]), np.finfo(float).tiny)
+        level = self.pyramid.getLevelForSize(self.getPlotPixels() * zoom)
+
+        box, extent = (None, None) if level <= self.level else self.getRegionBox(level, xlim, ylim)
+        regionKey = None if box is None else (level, box)
+
+        if regionKey == self._regionKey:
+            return
+
+        self._regionKey = regionKey
+
+        if self.regionImage is not None:
+            self.regionImage.remove()
+            self.regionImage = None
+
+        if box is not None:
+            img = self.pyramid.getRegion(level, box)
+            # Keep limits the user has zoomed to
+            self.regionImage = self.axes.imshow(self.enhance(img), cmap='gray', extent=extent)
+            self.axes.set_xlim(xlim)
+            self.axes.set_ylim(ylim)
+
+        self.axes.figure.canvas.draw_idle()
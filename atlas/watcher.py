@@ -0,0 +1,192 @@
+# **************************************************************************
+# *
+# * Authors:   Pablo Conesa       (pconesa@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+
+# inotify constants (from sys/inotify.h)
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE
+EVENT_HEADER = struct.Struct("iIII")
+
+
+def _loadInotify():
+    """ Returns libc if it provides inotify, None otherwise"""
+    libName = ctypes.util.find_library("c")
+    if libName is None:
+        return None
+    try:
+        libc = ctypes.CDLL(libName, use_errno=True)
+        libc.inotify_init1
+        libc.inotify_add_watch
+        return libc
+    except (OSError, AttributeError):
+        return None
+
+
+def createFileWatcher():
+    """ Returns an InotifyWatcher if the system supports it, a PollingWatcher otherwise"""
+    libc = _loadInotify()
+    if libc is not None:
+        try:
+            return InotifyWatcher(libc)
+        except OSError:
+            pass
+    return PollingWatcher()
+
+
+class PollingWatcher:
+    """ Tells if watched files or folders have changed since last time asked, comparing modification times.
+    Stand-in for InotifyWatcher when inotify is not available."""
+
+    def __init__(self):
+        self._paths = {}
+        self._snapshot = {}
+
+    def watch(self, path, recursive=False):
+        """ Starts watching a file or folder. If recursive, subfolders (present or future) are watched too"""
+        if path not in self._paths:
+            self._paths[path] = recursive
+            self._snapshot.update(self._getTimes(path, recursive))
+
+    def isWatching(self, path):
+        return path in self._paths
+
+    @classmethod
+    def _getTimes(cls, path, recursive):
+        """ Returns modification times of the path (and its subfolders if recursive)"""
+        times = {}
+        try:
+            times[path] = os.stat(path).st_mtime_ns
+        except OSError:
+            return times
+
+        if recursive and os.path.isdir(path):
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        times.update(cls._getTimes(entry.path, recursive))
+        return times
+
+    def hasChanged(self, timeout=0):
+        """ Returns True if anything watched changed since the last call (timeout is ignored)"""
+        snapshot = {}
+        for path, recursive in self._paths.items():
+            snapshot.update(self._getTimes(path, recursive))
+
+        changed = snapshot != self._snapshot
+        self._snapshot = snapshot
+        return changed
+
+    def close(self):
+        self._paths = {}
+        self._snapshot = {}
+
+
+class InotifyWatcher:
+    """ Tells if watched files or folders have changed since last time asked, using linux inotify events.
+    Asking is cheap: events are read from a non blocking file descriptor, no file is stat'ed."""
+
+    def __init__(self, libc):
+        self._libc = libc
+        self._fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        # watch descriptor -> (path, recursive)
+        self._watches = {}
+        self._paths = set()
+
+    def _addWatch(self, path, recursive):
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(path), WATCH_MASK)
+        if wd >= 0:
+            self._watches[wd] = (path, recursive)
+            self._paths.add(path)
+
+    def watch(self, path, recursive=False):
+        """ Starts watching a file or folder. If recursive, subfolders (present or future) are watched too"""
+        if path in self._paths:
+            return
+
+        self._addWatch(path, recursive)
+
+        if recursive and os.path.isdir(path):
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        self.watch(entry.path, recursive)
+
+    def isWatching(self, path):
+        return path in self._paths
+
+    def hasChanged(self, timeout=0):
+        """ Returns True if any event happened since the last call. Waits up to timeout seconds for it"""
+        if timeout and not select.select([self._fd], [], [], timeout)[0]:
+            return False
+
+        changed = False
+        while True:
+            try:
+                buffer = os.read(self._fd, 65536)
+            except BlockingIOError:
+                break
+
+            if not buffer:
+                break
+
+            changed = True
+            self._processEvents(buffer)
+
+        return changed
+
+    def _processEvents(self, buffer):
+        """ Watches new subfolders created under recursive watches"""
+        offset = 0
+        while offset < len(buffer):
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from(buffer, offset)
+            offset += EVENT_HEADER.size
+            name = buffer[offset:offset + length].rstrip(b"\0")
+            offset += length
+
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO) and wd in self._watches:
+                path, recursive = self._watches[wd]
+                if recursive:
+                    self.watch(os.path.join(path, os.fsdecode(name)), recursive)
+
+    def close(self):
+        os.close(self._fd)
+        self._watches = {}
+        self._paths = set()
@@ -37,7 +37,7 @@ setup(
     packages=find_packages(),
     install_requires=[requirements],
     package_data={  # Optional
-       'atlas': ['icon.png', 'protocols.conf'],
+       'atlas': ['icon.png', 'protocols.conf', 'tests/benchmark_baselines.json'],
     },
     entry_points={
         'pyworkflow.plugin': 'atlas = atlas'